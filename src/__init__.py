@@ -35,6 +35,16 @@ class _MyAPI(BundleAPI):
             return tool.GaudiViewXTool(session, ti.name)
         raise ValueError("trying to start unknown tool: %s" % ti.name)
 
+    @staticmethod
+    def register_command(bi, ci, logger):
+        from chimerax.core.commands import register
+        from . import cmd
+
+        if ci.name == "gaudiviewx filter":
+            register(ci.name, cmd.filter_desc, cmd.gaudiviewx_filter, logger=logger)
+        else:
+            raise ValueError("trying to register unknown command: %s" % ci.name)
+
     @staticmethod
     def get_class(class_name):
         if class_name == "GaudiViewXTool":
@@ -0,0 +1,331 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+##############
+#   GaudiViewX: UCSF ChimeraX extension to
+#   explore and analyze GaudiMM solutions
+
+#   https://github.com/insilichem/gaudiviewx
+
+#   Copyright 2019 Andrés Giner Antón, Jaime Rodriguez-Guerra
+#   and Jean-Didier Marechal
+
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+
+#        http://www.apache.org/licenses/LICENSE-2.0
+
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+##############
+
+# Imports
+# Python
+import hashlib
+import threading
+import tempfile
+import shutil
+import json
+import sys
+import os
+
+import numpy as np
+
+CACHE_VERSION = 1
+# Blocks hashed to fingerprint the content of an output file
+_HEAD_TAIL = 1 << 20
+_SAMPLE = 1 << 16
+_N_SAMPLES = 16
+
+
+def cache_dir(*parts):
+    """Directory inside the GaudiViewX user cache, created on demand."""
+    try:
+        from chimerax import app_dirs
+
+        base = app_dirs.user_cache_dir
+    except (ImportError, AttributeError):
+        base = os.path.join(tempfile.gettempdir(), "chimerax-cache")
+    path = os.path.join(base, "gaudiviewx", *parts)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def fingerprint(path):
+    """
+    Identify the current state of a file by its real path, size,
+    modification time and a hash of its head, tail and evenly spaced
+    blocks in between, so big files are fingerprinted in milliseconds.
+    """
+    path = os.path.realpath(path)
+    stat = os.stat(path)
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        if stat.st_size <= 2 * _HEAD_TAIL + _N_SAMPLES * _SAMPLE:
+            digest.update(f.read())
+        else:
+            digest.update(f.read(_HEAD_TAIL))
+            step = (stat.st_size - 2 * _HEAD_TAIL) // (_N_SAMPLES + 1)
+            for i in range(1, _N_SAMPLES + 1):
+                f.seek(_HEAD_TAIL + i * step)
+                digest.update(f.read(_SAMPLE))
+            f.seek(-_HEAD_TAIL, os.SEEK_END)
+            digest.update(f.read())
+    return {
+        "version": CACHE_VERSION,
+        "path": path,
+        "size": stat.st_size,
+        "mtime": stat.st_mtime_ns,
+        "hash": digest.hexdigest(),
+    }
+
+
+def _entry(path):
+    name = hashlib.sha1(os.path.realpath(path).encode("utf-8")).hexdigest()
+    return os.path.join(cache_dir("outputs"), name)
+
+
+def read_output(path):
+    """
+    Return the cached (first_line, objectives, keys, values) of a
+    .gaudi-output file, or None if it is not cached or it changed.
+    Scores are memory-mapped, one contiguous column per objective.
+    """
+    try:
+        entry = _entry(path)
+        with open(os.path.join(entry, "meta.json"), "r") as f:
+            meta = json.load(f)
+        if meta["fingerprint"] != fingerprint(path):
+            return None
+        keys = np.load(os.path.join(entry, "keys.npy"), mmap_mode="r")
+        values = np.load(os.path.join(entry, "values.npy"), mmap_mode="r")
+    except (OSError, ValueError, KeyError):
+        return None
+    keys = np.array([sys.intern(key) for key in keys.tolist()], dtype=object)
+    return meta["first_line"], meta["objectives"], keys, values
+
+
+def write_output(path, first_line, objectives, keys, values):
+    """Cache the parsed columns of a .gaudi-output file. Best effort."""
+    tmp = None
+    try:
+        entry = _entry(path)
+        meta = {
+            "fingerprint": fingerprint(path),
+            "first_line": first_line,
+            "objectives": list(objectives),
+        }
+        tmp = tempfile.mkdtemp(dir=os.path.dirname(entry))
+        np.save(os.path.join(tmp, "keys.npy"), np.array(keys, dtype=str))
+        np.save(os.path.join(tmp, "values.npy"), np.asfortranarray(values))
+        with open(os.path.join(tmp, "meta.json"), "w") as f:
+            json.dump(meta, f)
+        shutil.rmtree(entry, ignore_errors=True)
+        os.replace(tmp, entry)
+    except OSError:
+        if tmp is not None:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+
+class DirectoryCache(object):
+    """
+    Entries kept as directories in ``path``, shared by every ChimeraX
+    session. The least recently used entries are removed when the cache
+    grows over ``max_bytes``.
+    """
+
+    def __init__(self, path, max_bytes=0):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._size = None
+        self._lock = threading.RLock()
+
+    def _commit(self, tmp, entry, size):
+        """Move the ``tmp`` directory into place as ``entry``."""
+        with self._lock:
+            try:
+                os.rename(tmp, entry)
+            except OSError:
+                # Written meanwhile by another model or session
+                shutil.rmtree(tmp, ignore_errors=True)
+            else:
+                if self._size is not None:
+                    self._size += size
+            if self.max_bytes and self.size() > self.max_bytes:
+                self.prune(keep=entry)
+
+    def size(self):
+        with self._lock:
+            if self._size is None:
+                self._size = sum(size for _, size, _ in self._entries())
+            return self._size
+
+    def prune(self, max_bytes=None, keep=None):
+        """
+        Remove least recently used entries until under ``max_bytes``,
+        but never the ``keep`` entry, like the one just stored.
+        """
+        if max_bytes is None:
+            max_bytes = self.max_bytes
+        with self._lock:
+            entries = sorted(self._entries(), key=lambda entry: entry[2])
+            total = sum(size for _, size, _ in entries)
+            for path, size, _ in entries:
+                if total <= max_bytes:
+                    break
+                if path == keep:
+                    continue
+                shutil.rmtree(path, ignore_errors=True)
+                total -= size
+            self._size = total
+
+    def clear(self):
+        self.prune(0)
+
+    def _entries(self):
+        entries = []
+        for entry in os.scandir(self.path):
+            if not entry.is_dir() or entry.name.startswith("."):
+                continue
+            size = 0
+            for f in os.scandir(entry.path):
+                try:
+                    size += f.stat().st_size
+                except OSError:
+                    pass
+            entries.append((entry.path, size, entry.stat().st_mtime))
+        return entries
+
+
+class ExtractionCache(DirectoryCache):
+    """
+    Solution zips extracted to disk. Entries are named after the SHA1 of
+    the zip content, so each solution is extracted once.
+    """
+
+    def get(self, digest):
+        """Paths of the extracted members of a zip, or None."""
+        entry = os.path.join(self.path, digest)
+        try:
+            with open(os.path.join(entry, "members.json"), "r") as f:
+                names = json.load(f)
+            os.utime(entry)
+        except (OSError, ValueError):
+            return None
+        return [os.path.join(entry, name) for name in names]
+
+    def store(self, digest, members):
+        """Write the (member, bytes) pairs of a zip and return their paths."""
+        entry = os.path.join(self.path, digest)
+        tmp = tempfile.mkdtemp(dir=self.path, prefix=".tmp")
+        names, size = [], 0
+        for member, data in members:
+            name = os.path.basename(member)
+            with open(os.path.join(tmp, name), "wb") as f:
+                f.write(data)
+            names.append(name)
+            size += len(data)
+        with open(os.path.join(tmp, "members.json"), "w") as f:
+            json.dump(names, f)
+        self._commit(tmp, entry, size)
+        return [os.path.join(entry, name) for name in names]
+
+
+def solutions_key(paths, *parts):
+    """
+    Identify a set of solution files, whatever their order, by their real
+    path, size and modification time, together with ``parts``. Returns
+    the key and the position of each of ``paths`` in the sorted set.
+    """
+    real = [os.path.realpath(path) for path in paths]
+    unique = sorted(set(real))
+    position = {path: i for i, path in enumerate(unique)}
+    digest = hashlib.sha1(repr((CACHE_VERSION,) + parts).encode("utf-8"))
+    for path in unique:
+        stat = os.stat(path)
+        digest.update(
+            "{}\0{}\0{}\n".format(path, stat.st_size, stat.st_mtime_ns).encode("utf-8")
+        )
+    return digest.hexdigest(), [position[path] for path in real]
+
+
+class MatrixCache(DirectoryCache):
+    """
+    Condensed pairwise RMSD matrices of solution sets, as float32 in the
+    order of scipy.spatial.distance.pdist, named by solutions_key().
+    """
+
+    def get(self, key):
+        """The memory-mapped matrix stored as ``key``, or None."""
+        entry = os.path.join(self.path, key)
+        try:
+            matrix = np.load(os.path.join(entry, "matrix.npy"), mmap_mode="r")
+            os.utime(entry)
+        except (OSError, ValueError):
+            return None
+        return matrix
+
+    def fits(self, n):
+        """Whether the matrix of ``n`` solutions can be kept at all."""
+        return not self.max_bytes or 4 * (n * (n - 1) // 2) <= self.max_bytes
+
+    def store(self, key, n, fill):
+        """
+        Create a matrix for ``n`` solutions and ``fill`` it in place.
+        Returns it memory-mapped, or None if ``fill`` returns False. A
+        matrix that does not fit() is filled in memory and not stored.
+        """
+        if not self.fits(n):
+            matrix = np.empty(n * (n - 1) // 2, dtype=np.float32)
+            if fill(matrix) is False:
+                return None
+            return matrix
+        entry = os.path.join(self.path, key)
+        tmp = tempfile.mkdtemp(dir=self.path, prefix=".tmp")
+        try:
+            matrix = np.lib.format.open_memmap(
+                os.path.join(tmp, "matrix.npy"),
+                mode="w+",
+                dtype=np.float32,
+                shape=(n * (n - 1) // 2,),
+            )
+            complete = fill(matrix) is not False
+            matrix.flush()
+            size = matrix.nbytes
+            del matrix
+        except BaseException:
+            shutil.rmtree(tmp, ignore_errors=True)
+            raise
+        if not complete:
+            shutil.rmtree(tmp, ignore_errors=True)
+            return None
+        self._commit(tmp, entry, size)
+        return self.get(key)
+
+
+_extraction_cache = None
+
+
+def extraction_cache(max_bytes=0):
+    """The ExtractionCache shared by the whole process."""
+    global _extraction_cache
+    if _extraction_cache is None:
+        _extraction_cache = ExtractionCache(cache_dir("extracted"))
+    _extraction_cache.max_bytes = max_bytes
+    return _extraction_cache
+
+
+_matrix_cache = None
+
+
+def matrix_cache(max_bytes=0):
+    """The MatrixCache shared by the whole process."""
+    global _matrix_cache
+    if _matrix_cache is None:
+        _matrix_cache = MatrixCache(cache_dir("rmsd"))
+    _matrix_cache.max_bytes = max_bytes
+    return _matrix_cache
@@ -0,0 +1,560 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+##############
+#   GaudiViewX: UCSF ChimeraX extension to
+#   explore and analyze GaudiMM solutions
+
+#   https://github.com/insilichem/gaudiviewx
+
+#   Copyright 2019 Andrés Giner Antón, Jaime Rodriguez-Guerra
+#   and Jean-Didier Marechal
+
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+
+#        http://www.apache.org/licenses/LICENSE-2.0
+
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+##############
+
+# Imports
+# Python
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import copy
+import itertools
+import tempfile
+import shutil
+import os
+
+import numpy as np
+from scipy.cluster.hierarchy import linkage, fcluster
+
+
+class RMSDKernel(object):
+    """
+    Base of the RMSD kernels. The arrays named in ``shared`` can be
+    moved to memory-mapped files with share(), so that worker processes
+    receive their path instead of a pickled copy of the data.
+    """
+
+    shared = ()
+
+    def share(self, directory):
+        for name in self.shared:
+            if isinstance(getattr(self, name), np.memmap):
+                continue
+            path = os.path.join(directory, name + ".npy")
+            np.save(path, getattr(self, name))
+            setattr(self, name, np.load(path, mmap_mode="r"))
+
+    def lower_bound(self, i, others):
+        """A cheap lower bound of the RMSD to ``others``, or None."""
+        return None
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        for name in self.shared:
+            if isinstance(state[name], np.memmap):
+                state[name] = _SharedArray(state[name].filename)
+        return state
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            if isinstance(value, _SharedArray):
+                state[name] = np.load(value.path, mmap_mode="r")
+        self.__dict__.update(state)
+
+
+class _SharedArray(object):
+    def __init__(self, path):
+        self.path = path
+
+
+class SuperposedRMSD(RMSDKernel):
+    """
+    RMSD between solutions of a CoordinateSet after the optimal
+    superposition (Kabsch) of each of their molecules.
+
+    Each molecule is superposed on its own, like ChimeraX would align
+    each model, and the per-molecule RMSDs are combined weighting them
+    by their number of atoms: sqrt(sum(n_m * rmsd_m^2) / sum(n_m)),
+    which is the RMSD over all atoms with per-molecule fitting.
+    """
+
+    shared = ("centered", "norms")
+
+    def __init__(self, coords, slices):
+        self.slices = [s for s in slices if s.stop > s.start]
+        self.centered = np.array(coords, dtype=float)
+        for s in self.slices:
+            self.centered[:, s] -= self.centered[:, s].mean(axis=1, keepdims=True)
+        self.norms = np.stack(
+            [
+                np.einsum("naj,naj->n", self.centered[:, s], self.centered[:, s])
+                for s in self.slices
+            ],
+            axis=1,
+        )
+        self.n_atoms = sum(s.stop - s.start for s in self.slices)
+
+    def __len__(self):
+        return len(self.centered)
+
+    def __call__(self, i, others):
+        """RMSD of solution ``i`` against every solution in ``others``."""
+        others = np.asarray(others, dtype=int)
+        sd = np.zeros(len(others))
+        for m, s in enumerate(self.slices):
+            sd += self.norms[i, m] + self.norms[others, m]
+            sd -= 2 * _max_inner_product(self.centered[i, s], self.centered[others, s])
+        return np.sqrt(np.maximum(sd, 0) / self.n_atoms)
+
+
+class InPlaceRMSD(RMSDKernel):
+    """
+    Plain RMSD between solutions of a CoordinateSet, without any
+    fitting, for solutions that already share a reference frame, like
+    docking poses on the same receptor.
+
+    ``symmetry`` lists groups of interchangeable atoms. Each group of up
+    to MAX_GROUP atoms is matched in the permutation that gives the
+    lowest deviation, which is the minimum over all the combinations
+    because groups contribute to the RMSD independently.
+    """
+
+    shared = ("coords", "norms", "group_coords", "centroids")
+    MAX_GROUP = 4
+
+    def __init__(self, coords, symmetry=()):
+        coords = np.asarray(coords, dtype=float)
+        self.n_atoms = coords.shape[1]
+        self.centroids = coords.mean(axis=1)
+        groups = [list(g) for g in symmetry if 1 < len(g) <= self.MAX_GROUP]
+        grouped = [atom for group in groups for atom in group]
+        fixed = np.ones(self.n_atoms, dtype=bool)
+        fixed[grouped] = False
+        self.coords = coords[:, fixed].reshape(len(coords), -1)
+        self.norms = np.einsum("nx,nx->n", self.coords, self.coords)
+        self.group_coords = coords[:, grouped]
+        self.groups = []
+        start = 0
+        for group in groups:
+            permutations = np.array(list(itertools.permutations(range(len(group)))))
+            self.groups.append((start, len(group), permutations))
+            start += len(group)
+
+    def __len__(self):
+        return len(self.coords)
+
+    def __call__(self, i, others):
+        """RMSD of solution ``i`` against every solution in ``others``."""
+        others = np.asarray(others, dtype=int)
+        sd = (
+            self.norms[i]
+            + self.norms[others]
+            - 2 * (self.coords[others] @ self.coords[i])
+        )
+        for start, size, permutations in self.groups:
+            ref = self.group_coords[i, start : start + size]
+            batch = self.group_coords[others, start : start + size]
+            # Squared distances between every pair of atoms of the group
+            pairs = ((ref[None, :, None] - batch[:, None]) ** 2).sum(axis=-1)
+            cost = pairs[:, np.arange(size), permutations].sum(axis=-1)
+            sd += cost.min(axis=-1)
+        return np.sqrt(np.maximum(sd, 0) / self.n_atoms)
+
+    def lower_bound(self, i, others):
+        """
+        Distance between centroids: the mean squared deviation is never
+        below the squared mean deviation.
+        """
+        return np.linalg.norm(self.centroids[others] - self.centroids[i], axis=1)
+
+
+class MatrixRMSD(RMSDKernel):
+    """
+    RMSD read from a condensed pairwise matrix, as computed by
+    pairwise_rmsd(), for the solutions at ``order`` in the matrix.
+    """
+
+    shared = ("matrix", "order")
+
+    def __init__(self, matrix, order):
+        self.matrix = matrix
+        self.order = np.asarray(order, dtype=int)
+        self.n = _solutions_in(matrix)
+
+    def __len__(self):
+        return len(self.order)
+
+    def __call__(self, i, others):
+        """RMSD of solution ``i`` against every solution in ``others``."""
+        a = self.order[i]
+        b = self.order[np.asarray(others, dtype=int)]
+        low, high = np.minimum(a, b), np.maximum(a, b)
+        same = low == high
+        index = self.n * low - low * (low + 1) // 2 + high - low - 1
+        index[same] = 0
+        rmsd = self.matrix[index].astype(float)
+        rmsd[same] = 0
+        return rmsd
+
+
+def _solutions_in(matrix):
+    # From len(matrix) = n * (n - 1) / 2
+    return int(round((1 + np.sqrt(1 + 8 * len(matrix))) / 2))
+
+
+# Solutions compared in each call to the kernel when filling a matrix,
+# so the coordinates gathered for them stay small
+PAIRWISE_CHUNK = 2048
+
+
+def pairwise_rmsd(rmsd, matrix, progress=None):
+    """
+    Fill ``matrix`` with the condensed pairwise RMSD of the solutions of
+    ``rmsd``, one row at a time, in chunks of PAIRWISE_CHUNK. ``progress``
+    is called with the rows done; if it returns False, it stops and
+    returns False.
+    """
+    n, start = len(rmsd), 0
+    for i in range(n - 1):
+        for first in range(i + 1, n, PAIRWISE_CHUNK):
+            last = min(first + PAIRWISE_CHUNK, n)
+            matrix[start : start + last - first] = rmsd(i, np.arange(first, last))
+            start += last - first
+        if progress is not None and progress(i + 1) is False:
+            return False
+    return True
+
+
+def _max_inner_product(ref, batch):
+    """
+    Maximum of sum(ref . R(batch)) over rotations R, for each item of
+    ``batch``, from the singular values of the batched covariances.
+    """
+    covariance = np.einsum("ai,kaj->kij", ref, batch)
+    singular = np.linalg.svd(covariance, compute_uv=False)
+    # A reflection is not a rotation: flip the smallest singular value
+    reflection = np.linalg.det(covariance) < 0
+    singular[reflection, -1] *= -1
+    return singular.sum(axis=1)
+
+
+def leader_clustering(rmsd, cutoff, progress=None, processes=1, n_leaders=0):
+    """
+    Greedy leader clustering of the solutions of ``rmsd``, taken in
+    order: each one joins the first cluster whose leader is closer than
+    ``cutoff`` or becomes the leader of a new cluster. Each solution is
+    tested against all leaders in a single call to ``rmsd``, except those
+    that a lower bound proves too far (see _first_hit). With more than
+    one process, and only where processes can be forked, the work is
+    split across a process pool with the very same result; elsewhere it
+    runs in this process. The first ``n_leaders`` solutions are taken as leaders
+    of clusters 0 to n_leaders - 1 without testing them, to extend a
+    previous clustering.
+
+    Returns the 0-based cluster of each solution, the leaders and a dict
+    with the RMSDs ``evaluated`` and the leader tests ``skipped``, or
+    None if ``progress``, called with the solutions done, returns False.
+    """
+    if (
+        processes > 1
+        and len(rmsd) - n_leaders > PARALLEL_MIN_SOLUTIONS
+        and "fork" in multiprocessing.get_all_start_methods()
+    ):
+        return _parallel_leader_clustering(rmsd, cutoff, progress, processes, n_leaders)
+    labels, leaders, stats = _seed(rmsd, n_leaders)
+    for i in range(n_leaders, len(rmsd)):
+        hit, to_pivots = _first_hit(
+            rmsd, cutoff, i, leaders.indices, leaders.table, stats
+        )
+        if hit < 0:
+            hit = len(leaders)
+            leaders.add(i, to_pivots, stats)
+        labels[i] = hit
+        if progress is not None and progress(i + 1) is False:
+            return None
+    return labels, leaders.indices.tolist(), stats
+
+
+def rmsd_kernel(coordinates, in_place=False, symmetric=False):
+    """
+    RMSD kernel over a CoordinateSet: after superposing each molecule,
+    or in place, matching its symmetry-equivalent atoms if ``symmetric``.
+    """
+    if in_place:
+        symmetry = coordinates.symmetry_groups() if symmetric else ()
+        return InPlaceRMSD(coordinates.coords, symmetry)
+    return SuperposedRMSD(coordinates.coords, coordinates.slices)
+
+
+class LeaderClusters(object):
+    """
+    Outcome of leader_clustering() kept to extend it: the coordinates of
+    the leaders, in the atom order of ``reference``, and how their RMSD
+    was calculated. assign() clusters further solutions against them at
+    a cost proportional to the new solutions only.
+    """
+
+    def __init__(self, leaders, cutoff, selection, in_place=False, symmetric=False):
+        self.coords = leaders.coords
+        self.reference = leaders.reference
+        self.slices = leaders.slices
+        self.symmetry = leaders.symmetry_groups() if in_place and symmetric else ()
+        self.cutoff = cutoff
+        self.selection = selection
+        self.in_place = in_place
+        self.symmetric = symmetric
+
+    def __len__(self):
+        return len(self.coords)
+
+    def kernel(self, coords):
+        if self.in_place:
+            return InPlaceRMSD(coords, self.symmetry)
+        return SuperposedRMSD(coords, self.slices)
+
+    def assign(self, coordinates, progress=None):
+        """
+        0-based cluster of each solution of ``coordinates``, read with
+        the reference of these clusters, joining the clusters of this
+        clustering or starting new ones after them, and the
+        LeaderClusters with those new leaders too. These ones are left
+        untouched. None if ``progress`` returns False.
+        """
+        coords = np.concatenate((self.coords, coordinates.coords))
+        n = len(self.coords)
+
+        def offset(done):
+            return progress(done - n)
+
+        clusters = leader_clustering(
+            self.kernel(coords),
+            self.cutoff,
+            progress=None if progress is None else offset,
+            n_leaders=n,
+        )
+        if clusters is None:
+            return None
+        labels, leaders, _ = clusters
+        extended = copy.copy(self)
+        extended.coords = coords[leaders]
+        return labels[n:], extended
+
+
+class Dendrogram(object):
+    """
+    Hierarchical clustering of a condensed pairwise RMSD ``matrix`` with
+    a ``method`` of scipy's linkage, such as "single", "average" or
+    "complete". It is built once and cut at any RMSD by cut().
+    """
+
+    METHODS = ("single", "average", "complete")
+
+    def __init__(self, matrix, method="average"):
+        self.method = method
+        self.n = _solutions_in(matrix)
+        if self.n > 1:
+            self.linkage = linkage(np.asarray(matrix, dtype=float), method)
+        else:
+            self.linkage = np.empty((0, 4))
+
+    @property
+    def height(self):
+        """RMSD at which every solution is in one cluster."""
+        return float(self.linkage[:, 2].max()) if len(self.linkage) else 0.0
+
+    def cut(self, cutoff, order=None):
+        """
+        0-based cluster of the solutions at ``order`` in the matrix, all
+        by default, merging clusters up to ``cutoff`` apart. Clusters are
+        numbered by the first solution of ``order`` they contain.
+        """
+        if order is None:
+            order = np.arange(self.n)
+        if self.n > 1:
+            clusters = fcluster(self.linkage, cutoff, criterion="distance")[order]
+        else:
+            clusters = np.zeros(len(order), dtype=int)
+        _, first, labels = np.unique(clusters, return_index=True, return_inverse=True)
+        rank = np.empty(len(first), dtype=int)
+        rank[np.argsort(first)] = np.arange(len(first))
+        return rank[labels]
+
+
+# Below this, starting the processes costs more than it saves
+PARALLEL_MIN_SOLUTIONS = 1000
+# Candidates handed to each process per round
+BLOCK_PER_PROCESS = 32
+# Leaders whose RMSD to every other leader is kept for the bounds
+N_PIVOTS = 8
+# Fewer leaders than this are all tested, with no bounds
+PRUNE_MIN_LEADERS = 64
+# Slack of the bounds for rounding errors, in Angstrom
+BOUND_TOLERANCE = 1e-6
+
+
+class _Leaders(object):
+    """
+    Leaders found so far and, for each leader after the first N_PIVOTS,
+    its RMSD to them in ``table``. Both grow by doubling.
+    """
+
+    def __init__(self, rmsd):
+        self.rmsd = rmsd
+        self._indices = np.empty(64, dtype=int)
+        self._table = np.empty((64, N_PIVOTS))
+        self.n = 0
+
+    def __len__(self):
+        return self.n
+
+    @property
+    def indices(self):
+        return self._indices[: self.n]
+
+    @property
+    def table(self):
+        return self._table[: max(self.n - N_PIVOTS, 0)]
+
+    def add(self, i, to_pivots, stats):
+        if self.n == len(self._indices):
+            self._indices = np.resize(self._indices, 2 * self.n)
+            self._table = np.resize(self._table, (2 * self.n, N_PIVOTS))
+        if self.n >= N_PIVOTS:
+            if len(to_pivots) < N_PIVOTS:
+                to_pivots = self.rmsd(i, self._indices[:N_PIVOTS])
+                stats["evaluated"] += N_PIVOTS
+            self._table[self.n - N_PIVOTS] = to_pivots
+        self._indices[self.n] = i
+        self.n += 1
+
+
+def _first_hit(rmsd, cutoff, i, leaders, table, stats):
+    """
+    Position of the first of ``leaders`` within ``cutoff`` of solution
+    ``i``, or -1, and the RMSD of ``i`` to the pivots.
+
+    The pivots, the first N_PIVOTS leaders, are always tested. RMSD is a
+    metric, so by the triangle inequality the RMSD to any other leader L
+    is at least |rmsd(i, p) - rmsd(L, p)| for each pivot p; leaders
+    whose bound, or that of rmsd.lower_bound(), reaches the cutoff are
+    skipped without changing the result.
+    """
+    if len(leaders) <= PRUNE_MIN_LEADERS:
+        # Not worth a second call to rmsd
+        found = rmsd(i, leaders)
+        stats["evaluated"] += len(leaders)
+        hits = np.flatnonzero(found < cutoff)
+        return (hits[0] if len(hits) else -1), found[:N_PIVOTS]
+    n_pivots = N_PIVOTS
+    to_pivots = rmsd(i, leaders[:n_pivots])
+    stats["evaluated"] += n_pivots
+    hits = np.flatnonzero(to_pivots < cutoff)
+    if len(hits):
+        return hits[0], to_pivots
+    rest = leaders[n_pivots:]
+    if not len(rest):
+        return -1, to_pivots
+    bound = np.abs(table - to_pivots).max(axis=1)
+    kernel_bound = rmsd.lower_bound(i, rest)
+    if kernel_bound is not None:
+        bound = np.maximum(bound, kernel_bound)
+    candidates = np.flatnonzero(bound - BOUND_TOLERANCE < cutoff)
+    stats["skipped"] += len(rest) - len(candidates)
+    stats["evaluated"] += len(candidates)
+    if len(candidates):
+        hits = np.flatnonzero(rmsd(i, rest[candidates]) < cutoff)
+        if len(hits):
+            return n_pivots + candidates[hits[0]], to_pivots
+    return -1, to_pivots
+
+
+def _seed(rmsd, n_leaders):
+    labels = np.empty(len(rmsd), dtype=int)
+    leaders = _Leaders(rmsd)
+    stats = {"evaluated": 0, "skipped": 0}
+    for i in range(n_leaders):
+        labels[i] = i
+        leaders.add(i, (), stats)
+    return labels, leaders, stats
+
+
+def _parallel_leader_clustering(rmsd, cutoff, progress, processes, n_leaders=0):
+    # Candidates are handled in blocks: the processes look for the first
+    # hit among the leaders known before the block, in parallel, and
+    # then the block is resolved in order against the leaders it adds,
+    # which gives the same clusters as the sequential algorithm.
+    directory = tempfile.mkdtemp(prefix="gaudiviewx-")
+    try:
+        rmsd.share(directory)
+        # Spawning would start a new ChimeraX in each process
+        context = multiprocessing.get_context("fork")
+        with ProcessPoolExecutor(
+            processes, context, initializer=_init_worker, initargs=(rmsd,)
+        ) as executor:
+            labels, leaders, stats = _seed(rmsd, n_leaders)
+            block = BLOCK_PER_PROCESS * processes
+            for start in range(n_leaders, len(rmsd), block):
+                candidates = np.arange(start, min(start + block, len(rmsd)))
+                known = len(leaders)
+                hits = np.full(len(candidates), -1)
+                if known:
+                    chunks = np.array_split(candidates, processes)
+                    futures = [
+                        executor.submit(
+                            _first_hits,
+                            chunk,
+                            leaders.indices.copy(),
+                            leaders.table.copy(),
+                            cutoff,
+                        )
+                        for chunk in chunks
+                        if len(chunk)
+                    ]
+                    results = [future.result() for future in futures]
+                    hits = np.concatenate([hits for hits, _ in results])
+                    for _, worker_stats in results:
+                        for name, value in worker_stats.items():
+                            stats[name] += value
+                for i, hit in zip(candidates, hits):
+                    if hit < 0 and len(leaders) > known:
+                        # Leaders found in this same block
+                        others = leaders.indices[known:]
+                        found = np.flatnonzero(rmsd(i, others) < cutoff)
+                        stats["evaluated"] += len(others)
+                        if len(found):
+                            hit = known + found[0]
+                    if hit < 0:
+                        hit = len(leaders)
+                        leaders.add(i, (), stats)
+                    labels[i] = hit
+                if progress is not None and progress(candidates[-1] + 1) is False:
+                    return None
+            return labels, leaders.indices.tolist(), stats
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+_worker_rmsd = None
+
+
+def _init_worker(rmsd):
+    global _worker_rmsd
+    _worker_rmsd = rmsd
+
+
+def _first_hits(candidates, leaders, table, cutoff):
+    hits = np.full(len(candidates), -1)
+    stats = {"evaluated": 0, "skipped": 0}
+    for n, i in enumerate(candidates):
+        hits[n], _ = _first_hit(_worker_rmsd, cutoff, i, leaders, table, stats)
+    return hits, stats
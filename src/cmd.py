@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+##############
+#   GaudiViewX: UCSF ChimeraX extension to
+#   explore and analyze GaudiMM solutions
+
+#   https://github.com/insilichem/gaudiviewx
+
+#   Copyright 2019 Andrés Giner Antón, Jaime Rodriguez-Guerra
+#   and Jean-Didier Marechal
+
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+
+#        http://www.apache.org/licenses/LICENSE-2.0
+
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+##############
+
+# Imports
+# Python
+import os
+
+# ChimeraX
+from chimerax.core.commands import CmdDesc, StringArg, OpenFileNameArg, SaveFileNameArg
+from chimerax.core.errors import UserError
+
+# Relative
+from . import gaudireader
+from .store import SolutionStore
+from .filtering import compile_expression, apply_filter
+
+
+def gaudiviewx_filter(session, path, expression, output=None):
+    """
+    Filter the solutions of a .gaudi-output file with an expression,
+    like ``(Score < -8 and Clashes <= 2) or Contacts > 40``, and write
+    the kept ones to ``output``. No graphical interface is needed.
+    """
+    try:
+        expression = compile_expression(expression)
+    except ValueError as e:
+        raise UserError(str(e))
+    if output is None:
+        output = os.path.splitext(path)[0] + "_filtered.gaudi-output"
+
+    results = gaudireader.load_output(path)
+    store = SolutionStore.from_results(results)
+    try:
+        apply_filter(store, expression)
+    except ValueError as e:
+        raise UserError(
+            "{}. Objectives are: {}".format(e, ", ".join(store.headers[1:]))
+        )
+    keys, values = store.objectives(len(results.objectives))
+    gaudireader.write_output(
+        output, results.first_line, results.objectives, keys, values
+    )
+    session.logger.info(
+        "Kept {} of {} solutions of {} in {}".format(
+            len(store), store.size, path, output
+        )
+    )
+
+
+filter_desc = CmdDesc(
+    required=[("path", OpenFileNameArg), ("expression", StringArg)],
+    keyword=[("output", SaveFileNameArg)],
+    synopsis="Filter the solutions of a GaudiMM output file",
+)
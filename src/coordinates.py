@@ -0,0 +1,308 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+##############
+#   GaudiViewX: UCSF ChimeraX extension to
+#   explore and analyze GaudiMM solutions
+
+#   https://github.com/insilichem/gaudiviewx
+
+#   Copyright 2019 Andrés Giner Antón, Jaime Rodriguez-Guerra
+#   and Jean-Didier Marechal
+
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+
+#        http://www.apache.org/licenses/LICENSE-2.0
+
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+##############
+
+# Imports
+# Python
+from concurrent.futures import ThreadPoolExecutor
+import fnmatch
+import os
+
+import numpy as np
+
+# Relative
+from .gaudireader import read_zip
+
+# Solutions read ahead by each load_coordinates() worker
+READ_AHEAD = 4
+
+
+class Molecule(object):
+    """
+    Atoms of one @<TRIPOS>MOLECULE record of a mol2 file. ``bonds`` is
+    an (n, 2) array of atom indices, or None if bonds were not read.
+    """
+
+    def __init__(self, name, coords, atom_names, atom_types, residues, bonds=None):
+        self.name = name
+        self.coords = coords
+        self.atom_names = atom_names
+        self.atom_types = atom_types
+        self.residues = residues
+        self.bonds = bonds
+        self.ids = None
+
+    def __len__(self):
+        return len(self.coords)
+
+    @property
+    def label(self):
+        """Name of the member it was read from: Ligand for Ligand_1.mol2."""
+        return os.path.splitext(os.path.basename(self.name))[0].split("_")[0]
+
+
+def read_mol2(data, name="", bonds=False):
+    """
+    Read the atoms, and optionally the bonds, of every molecule in the
+    mol2 ``data`` bytes, without building any ChimeraX model.
+    """
+    molecules = []
+    for section in data.decode("utf-8", "replace").split("@<TRIPOS>")[1:]:
+        header, _, body = section.partition("\n")
+        header = header.strip()
+        if header == "MOLECULE":
+            molecules.append(None)
+        elif header == "BOND" and bonds and molecules and molecules[-1] is not None:
+            molecule = molecules[-1]
+            rows = [line.split() for line in body.splitlines() if line.strip()]
+            index = {atom_id: i for i, atom_id in enumerate(molecule.ids)}
+            molecule.bonds = np.array(
+                [(index[row[1]], index[row[2]]) for row in rows], dtype=int
+            ).reshape(-1, 2)
+        elif header == "ATOM":
+            rows = [line.split() for line in body.splitlines() if line.strip()]
+            molecule = Molecule(
+                name,
+                np.array([row[2:5] for row in rows], dtype=float).reshape(-1, 3),
+                [row[1] for row in rows],
+                [row[5] for row in rows],
+                [(row[6], row[7]) if len(row) > 7 else ("", "") for row in rows],
+            )
+            molecule.ids = [row[0] for row in rows]
+            if molecules and molecules[-1] is None:
+                molecules[-1] = molecule
+            else:
+                molecules.append(molecule)
+    return [molecule for molecule in molecules if molecule is not None]
+
+
+def read_solution(path, bonds=False):
+    """Molecules of every .mol2 member of a solution zip, in order."""
+    _, members = read_zip(path)
+    molecules = []
+    for member, data in members:
+        molecules.extend(read_mol2(data, member, bonds))
+    return molecules
+
+
+def symmetry_groups(molecules):
+    """
+    Interchangeable atoms of a topology, as lists of indices over all
+    the atoms of ``molecules``: terminal atoms of the same mol2 type
+    bonded to the same atom, like the hydrogens of a methyl group or
+    the oxygens of a carboxylate. Needs molecules read with bonds.
+    """
+    groups, offset = [], 0
+    for molecule in molecules:
+        if molecule.bonds is not None and len(molecule.bonds):
+            degree = np.bincount(molecule.bonds.ravel(), minlength=len(molecule))
+            by_parent = {}
+            for a, b in molecule.bonds:
+                for atom, parent in ((a, b), (b, a)):
+                    if degree[atom] == 1:
+                        key = (parent, molecule.atom_types[atom])
+                        by_parent.setdefault(key, []).append(offset + atom)
+            groups.extend(group for group in by_parent.values() if len(group) > 1)
+        offset += len(molecule)
+    return groups
+
+
+class AtomSelection(object):
+    """
+    Atoms compared when clustering: all of them, the ligand (the
+    smallest molecule), the molecules of one name, like "Ligand" for the
+    Ligand_*.mol2 members, or an atom spec. Specs are matched against the
+    mol2 records and support the residue and atom parts of the ChimeraX
+    syntax: ``:LIG``, ``:12``, ``@C1,C2``, ``:LIG@N*`` or several of them
+    separated by spaces.
+    """
+
+    MODES = ("all", "ligand", "molecule", "spec")
+
+    def __init__(self, mode="all", value=None):
+        if mode not in self.MODES:
+            raise ValueError("Unknown atom selection: {}".format(mode))
+        self.mode = mode
+        self.value = value
+
+    def __repr__(self):
+        if self.value is None:
+            return self.mode
+        return "{} {}".format(self.mode, self.value)
+
+    def indices(self, molecules):
+        """Indices of the selected atoms over all the atoms of ``molecules``."""
+        mask = []
+        if self.mode == "ligand" and molecules:
+            ligand = min(range(len(molecules)), key=lambda m: len(molecules[m]))
+        for m, molecule in enumerate(molecules):
+            if self.mode == "all":
+                mask.append(np.ones(len(molecule), dtype=bool))
+            elif self.mode == "ligand":
+                mask.append(np.full(len(molecule), m == ligand))
+            elif self.mode == "molecule":
+                mask.append(np.full(len(molecule), molecule.label == self.value))
+            else:
+                mask.append(_spec_mask(molecule, self.value))
+        if not mask:
+            return np.empty(0, dtype=int)
+        indices = np.flatnonzero(np.concatenate(mask))
+        if not len(indices):
+            raise ValueError("No atoms match the selection {!r}".format(self))
+        return indices
+
+
+def _spec_mask(molecule, spec):
+    mask = np.zeros(len(molecule), dtype=bool)
+    for term in spec.split():
+        residues, _, atoms = term.partition("@")
+        if residues and not residues.startswith(":"):
+            raise ValueError("Unsupported atom spec: {}".format(term))
+        residues = [r for r in residues[1:].split(",") if r]
+        atoms = [a for a in atoms.split(",") if a]
+        for i, (name, (number, residue)) in enumerate(
+            zip(molecule.atom_names, molecule.residues)
+        ):
+            if residues and not any(
+                r == number or fnmatch.fnmatchcase(residue, r)
+                # mol2 residue names usually carry the number: LIG1, ALA12
+                or fnmatch.fnmatchcase(residue.rstrip("0123456789"), r)
+                for r in residues
+            ):
+                continue
+            if atoms and not any(fnmatch.fnmatchcase(name, a) for a in atoms):
+                continue
+            mask[i] = True
+    return mask
+
+
+def topology(molecules):
+    """
+    Identity of every atom of ``molecules``, in order: molecule, by its
+    label and occurrence of that label, so the members of a zip may come
+    in any order, residue, atom name and occurrence of that name in the
+    residue.
+    """
+    atoms, seen, labels = [], {}, {}
+    for molecule in molecules:
+        labels[molecule.label] = labels.get(molecule.label, -1) + 1
+        m = (molecule.label, labels[molecule.label])
+        for name, residue in zip(molecule.atom_names, molecule.residues):
+            key = (m, residue, name)
+            seen[key] = seen.get(key, -1) + 1
+            atoms.append(key + (seen[key],))
+    return tuple(atoms)
+
+
+class CoordinateSet(object):
+    """
+    Coordinates of the selected atoms of N solutions sharing one
+    topology, as a single (N, atoms, 3) tensor, in the atom order of the
+    first solution. ``molecules`` holds the topology of the first
+    solution, ``atoms`` the indices of the selected atoms in it and
+    ``slices`` which of the selected atoms belong to each molecule.
+    ``reference`` identifies the selected atoms as topology() does, to
+    read more solutions in the same order.
+    """
+
+    def __init__(self, coords, molecules, atoms=None, reference=None):
+        self.coords = coords
+        self.molecules = molecules
+        self.reference = reference
+        if atoms is None:
+            atoms = np.arange(sum(len(molecule) for molecule in molecules))
+        self.atoms = atoms
+        offsets = np.cumsum([0] + [len(molecule) for molecule in molecules])
+        bounds = np.searchsorted(atoms, offsets).tolist()
+        self.slices = [slice(a, b) for a, b in zip(bounds[:-1], bounds[1:])]
+
+    def __len__(self):
+        return len(self.coords)
+
+    def symmetry_groups(self):
+        """symmetry_groups() of the topology, over the selected atoms."""
+        position = {atom: i for i, atom in enumerate(self.atoms.tolist())}
+        groups = []
+        for group in symmetry_groups(self.molecules):
+            group = [position[atom] for atom in group if atom in position]
+            if len(group) > 1:
+                groups.append(group)
+        return groups
+
+
+def load_coordinates(paths, workers=4, progress=None, selection=None, reference=None):
+    """
+    Read the solution zips in ``paths`` on ``workers`` threads into a
+    CoordinateSet of the atoms chosen by ``selection``, an AtomSelection
+    of all atoms by default, or of the atoms of ``reference``, taken from
+    a previous CoordinateSet to read more solutions in the same order.
+    ``progress`` is called with the number of solutions read so far; if
+    it returns False loading stops and None is returned. Raises
+    ValueError if a solution lacks any selected atom.
+    """
+    if selection is None:
+        selection = AtomSelection()
+    coords, first = None, None
+    # Index of the selected atoms in each topology, in the order of the
+    # first solution, so the selection is resolved once per topology
+    index_maps = {}
+    # Solutions read ahead: only these are parsed at once, not all of them
+    window = READ_AHEAD * max(workers, 1)
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        futures = {}
+        try:
+            for i in range(len(paths)):
+                for j in range(i + len(futures), min(i + window, len(paths))):
+                    futures[j] = executor.submit(read_solution, paths[j], j == 0)
+                molecules = futures.pop(i).result()
+                atoms = topology(molecules)
+                if first is None:
+                    first = molecules
+                    if reference is None:
+                        selected = selection.indices(molecules)
+                        reference = [atoms[atom] for atom in selected]
+                        index_maps[atoms] = selected
+                    coords = np.empty((len(paths), len(reference), 3))
+                index = index_maps.get(atoms)
+                if index is None:
+                    position = {atom: n for n, atom in enumerate(atoms)}
+                    try:
+                        index = np.array([position[atom] for atom in reference])
+                    except KeyError:
+                        raise ValueError(
+                            "{} does not have the selected atoms".format(paths[i])
+                        )
+                    index_maps[atoms] = index
+                if molecules is first:
+                    selected = index
+                if molecules:
+                    coords[i] = np.concatenate([m.coords for m in molecules])[index]
+                if progress is not None and progress(i + 1) is False:
+                    return None
+        finally:
+            for future in futures.values():
+                future.cancel()
+    if first is None:
+        return CoordinateSet(np.empty((0, 0, 3)), [])
+    return CoordinateSet(coords, first, selected, reference)
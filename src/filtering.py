@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+##############
+#   GaudiViewX: UCSF ChimeraX extension to
+#   explore and analyze GaudiMM solutions
+
+#   https://github.com/insilichem/gaudiviewx
+
+#   Copyright 2019 Andrés Giner Antón, Jaime Rodriguez-Guerra
+#   and Jean-Didier Marechal
+
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+
+#        http://www.apache.org/licenses/LICENSE-2.0
+
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+##############
+
+# Imports
+# Python
+import re
+
+import numpy as np
+
+OPERATORS = {
+    ">": np.greater,
+    "<": np.less,
+    "=": np.equal,
+    "≥": np.greater_equal,
+    "≤": np.less_equal,
+    "≠": np.not_equal,
+}
+
+
+class Condition(object):
+    """Comparison of one objective against a threshold."""
+
+    def __init__(self, objective, operator, threshold):
+        if operator not in OPERATORS:
+            raise ValueError("Unknown operator '{}'".format(operator))
+        self.objective = objective
+        self.operator = operator
+        self.threshold = float(threshold)
+
+    def __repr__(self):
+        return "{} {} {}".format(self.objective, self.operator, self.threshold)
+
+    def mask(self, store, rows):
+        try:
+            column = store.columns[store.headers.index(self.objective)]
+        except ValueError:
+            raise ValueError("Unknown objective '{}'".format(self.objective))
+        if not np.issubdtype(column.dtype, np.number):
+            raise ValueError("'{}' is not an objective".format(self.objective))
+        return OPERATORS[self.operator](column[rows], self.threshold)
+
+
+class And(object):
+    def __init__(self, *terms):
+        self.terms = terms
+
+    def __repr__(self):
+        return "(" + " and ".join(map(repr, self.terms)) + ")"
+
+    def mask(self, store, rows):
+        mask = np.ones(len(rows), dtype=bool)
+        for term in self.terms:
+            mask &= term.mask(store, rows)
+        return mask
+
+
+class Or(object):
+    def __init__(self, *terms):
+        self.terms = terms
+
+    def __repr__(self):
+        return "(" + " or ".join(map(repr, self.terms)) + ")"
+
+    def mask(self, store, rows):
+        mask = np.zeros(len(rows), dtype=bool)
+        for term in self.terms:
+            mask |= term.mask(store, rows)
+        return mask
+
+
+def apply_filter(store, expression):
+    """
+    Keep the shown rows of a SolutionStore matching expression, and
+    remember it so solutions appended later are filtered too.
+    """
+    store.rows = store.rows[expression.mask(store, store.rows)]
+    store.filter = combine(store.filter, expression)
+
+
+def combine(filter, expression):
+    """Expression passed by the rows passing ``filter``, if any, and ``expression``."""
+    if filter is None:
+        return expression
+    return And(filter, expression)
+
+
+class Not(object):
+    def __init__(self, term):
+        self.term = term
+
+    def __repr__(self):
+        return "not " + repr(self.term)
+
+    def mask(self, store, rows):
+        return ~self.term.mask(store, rows)
+
+
+# Expression language
+# expression := conjunction ("or" conjunction)*
+# conjunction := negation ("and" negation)*
+# negation := "not" negation | "(" expression ")" | OBJECTIVE OPERATOR NUMBER
+ALIASES = {">=": "≥", "<=": "≤", "!=": "≠", "==": "="}
+
+_TOKENS = re.compile(
+    r"""\s*(?:
+    (?P<number>[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)
+    |(?P<operator>>=|<=|!=|==|[<>=≤≥≠])
+    |(?P<paren>[()])
+    |(?P<name>[A-Za-z_][\w.]*|"[^"]*"|'[^']*')
+    )""",
+    re.VERBOSE,
+)
+
+
+def compile_expression(text):
+    """
+    Compile a filter expression, like
+    ``(Score < -8 and Clashes <= 2) or Contacts > 40``, into a tree of
+    Condition, And, Or and Not nodes. Objective names with unusual
+    characters can be quoted. Raises ValueError on syntax errors.
+    """
+    tokens = _tokenize(text)
+    expression, position = _parse_or(tokens, 0)
+    if position != len(tokens):
+        raise ValueError("Unexpected '{}' in filter".format(tokens[position][1]))
+    return expression
+
+
+def _tokenize(text):
+    tokens, position = [], 0
+    text = text.strip()
+    while position < len(text):
+        match = _TOKENS.match(text, position)
+        if match is None or match.end() == position:
+            raise ValueError(
+                "Invalid filter syntax at '{}'".format(text[position:].strip())
+            )
+        kind = match.lastgroup
+        value = match.group(kind)
+        if kind == "name" and value.lower() in ("and", "or", "not"):
+            kind = value = value.lower()
+        elif kind == "name" and value[0] in "'\"":
+            value = value[1:-1]
+        tokens.append((kind, value))
+        position = match.end()
+    return tokens
+
+
+def _peek(tokens, position):
+    if position < len(tokens):
+        return tokens[position][0]
+
+
+def _parse_or(tokens, position):
+    terms = []
+    term, position = _parse_and(tokens, position)
+    terms.append(term)
+    while _peek(tokens, position) == "or":
+        term, position = _parse_and(tokens, position + 1)
+        terms.append(term)
+    return (terms[0] if len(terms) == 1 else Or(*terms)), position
+
+
+def _parse_and(tokens, position):
+    terms = []
+    term, position = _parse_not(tokens, position)
+    terms.append(term)
+    while _peek(tokens, position) == "and":
+        term, position = _parse_not(tokens, position + 1)
+        terms.append(term)
+    return (terms[0] if len(terms) == 1 else And(*terms)), position
+
+
+def _parse_not(tokens, position):
+    kind = _peek(tokens, position)
+    if kind == "not":
+        term, position = _parse_not(tokens, position + 1)
+        return Not(term), position
+    if kind == "paren" and tokens[position][1] == "(":
+        term, position = _parse_or(tokens, position + 1)
+        if _peek(tokens, position) != "paren" or tokens[position][1] != ")":
+            raise ValueError("Missing ')' in filter")
+        return term, position + 1
+    kinds = [_peek(tokens, position + i) for i in range(3)]
+    if kinds != ["name", "operator", "number"]:
+        raise ValueError(
+            "Expected a comparison like 'Score < -8' in filter, got '{}'".format(
+                " ".join(value for _, value in tokens[position : position + 3])
+            )
+        )
+    objective, operator, number = [
+        value for _, value in tokens[position : position + 3]
+    ]
+    return Condition(objective, ALIASES.get(operator, operator), number), position + 3
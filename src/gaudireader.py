@@ -25,93 +25,535 @@
 
 # Imports
 # Python
-import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from array import array
+from io import BytesIO
+import hashlib
 import zipfile
 import yaml
+import sys
 import os
 
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
+import numpy as np
+
 # ChimeraX
 from chimerax.core import models, io
 from chimerax.core.commands import run, concise_model_spec
 
+# Relative
+from . import cache
+from .settings import get_settings
+
+
+# Raised by structure readers that cannot work on in-memory streams,
+# unlike the errors of malformed files, which are left to propagate
+STREAM_ERRORS = (AttributeError, TypeError, OSError)
+
 
 class GaudiModel(object):
     def __init__(self, controller, path, session, *args, **kwargs):
         self.path = path
         self.controller = controller
         self.basedir = os.path.dirname(path)
-        self.data, self.headers, self.keys = self.parse()
-        self.tempdir = tempfile.mkdtemp("gaudiviewx")
+        self.results = self.parse()
+        self.first_line = self.results.first_line
+        self.index = {key: row for row, key in enumerate(self.results.keys)}
         self.session = session
 
+    @property
+    def headers(self):
+        return self.results.headers
+
+    @property
+    def keys(self):
+        return self.index.keys()
+
     def parse(self):
-        with open(self.path, "r") as f:
-            self.first_line = f.readline()
-            self.raw_data = yaml.safe_load(f)
-        datarray = [[k] + v for k, v in self.raw_data["GAUDI.results"].items()]
-        keys = self.raw_data["GAUDI.results"].keys()
-        header = ["Filename"] + list(
-            map(lambda text: text.split()[0], self.raw_data["GAUDI.objectives"])
-        )
-        return datarray, header, keys
+        return load_output(self.path)
 
-    def parse_zip(self, key):
+    def parse_zip(self, key, fetched=None):
         path = os.path.join(self.basedir, key)
-        name = os.path.splitext(os.path.basename(path))[0]
         try:
-            z = zipfile.ZipFile(path)
-        except:
+            digest, members = fetched or self.read_zip(key)
+        except (OSError, zipfile.BadZipFile):
             print("{} is not a valid GAUDI result".format(path))
         else:
-            tmp = os.path.join(self.tempdir, name)
+            if get_settings(self.session).zip_loading == "memory":
+                self.controller.models[key] = self.open_buffers(key, digest, members)
+            else:
+                self.controller.models[key] = self.open_extracted(key, digest, members)
+
+    def fetch(self, key):
+        """
+        The part of parse_zip that does not need ChimeraX: read the zip
+        and, when loading from disk, extract it. Thread-safe.
+        """
+        digest, members = self.read_zip(key)
+        if get_settings(self.session).zip_loading != "memory":
+            self.extract(digest, members)
+        return digest, members
+
+    def read_zip(self, key):
+        return read_zip(os.path.join(self.basedir, key))
+
+    def open_buffers(self, key, digest, members):
+        """
+        Open the (member, bytes) pairs of a solution zip without touching
+        the disk. If the structure reader cannot work on streams, that
+        member alone is extracted and opened from the file system instead.
+        """
+        name = os.path.splitext(os.path.basename(key))[0]
+        models = []
+        for i, (member, data) in enumerate(members):
+            mol2_name = model_name(member, name)
             try:
-                os.mkdir(tmp)
-            except OSError:
-                pass
-            z.extractall(tmp)
-            mol2 = [
-                os.path.join(tmp, name)
-                for name in z.namelist()
-                if name.endswith(".mol2")
-            ]
-            models = []
-            for mol2_file in mol2:
-                mol2_name = os.path.splitext(os.path.basename(mol2_file))[0].split("_")[0] + "_" + name
-                model, _ = io.open_data(
-                    self.session, mol2_file, format=None, name=mol2_name
-                )
-                models += model
-            z.close()
-            self.controller.models[key] = models
+                model = open_stream(self.session, BytesIO(data), member, mol2_name)
+            except STREAM_ERRORS:
+                # The reader needs a file: write that member alone
+                path = self.extract("{}-{}".format(digest, i), [(member, data)])[0]
+                model = self.open_file(path, mol2_name)
+            models += model
+        return models
+
+    def open_extracted(self, key, digest, members):
+        name = os.path.splitext(os.path.basename(key))[0]
+        models = []
+        for mol2_file, (member, _) in zip(self.extract(digest, members), members):
+            models += self.open_file(mol2_file, model_name(member, name))
+        return models
+
+    def extract(self, digest, members):
+        extracted = cache.extraction_cache(
+            get_settings(self.session).extract_cache_megabytes * 2 ** 20
+        )
+        paths = extracted.get(digest)
+        if paths is None:
+            paths = extracted.store(digest, members)
+        return paths
+
+    def open_file(self, mol2_file, mol2_name):
+        model, _ = io.open_data(self.session, mol2_file, format=None, name=mol2_name)
+        return model
+
+
+def read_zip(path):
+    """
+    Hash a solution zip and decompress its .mol2 members in memory.
+    Returns the SHA1 of the zip and a list of (member, bytes) pairs.
+    """
+    with open(path, "rb") as f:
+        raw = f.read()
+    with zipfile.ZipFile(BytesIO(raw)) as z:
+        members = [(member, z.read(member)) for member in mol2_members(z)]
+    return hashlib.sha1(raw).hexdigest(), members
+
+
+def mol2_members(z):
+    return [name for name in z.namelist() if name.endswith(".mol2")]
+
+
+def model_name(member, name):
+    return os.path.splitext(os.path.basename(member))[0].split("_")[0] + "_" + name
+
+
+def open_stream(session, stream, filename, name):
+    """Open an in-memory structure with the reader registered for its format."""
+    fmt = io.format_from_name(io.deduce_format(filename)[0])
+    stream.name = filename
+    model, _ = fmt.open_func(session, stream, file_name=filename, format_name=fmt.name)
+    for m in model:
+        m.name = name
+    return model
+
+
+class GaudiResults(object):
+    """
+    Columnar store of a .gaudi-output file: an array with the zip
+    keys and a (solutions, objectives) float array with their scores.
+    """
+
+    def __init__(self, first_line, objectives, keys, values):
+        self.first_line = first_line
+        self.objectives = objectives
+        self.keys = keys
+        self.values = values
+
+    def __len__(self):
+        return len(self.keys)
+
+    @property
+    def headers(self):
+        return ["Filename"] + [text.split()[0] for text in self.objectives]
+
+
+def load_output(path):
+    """
+    Same as parse_output, but going through the on-disk cache of
+    parsed columns, which is invalidated when the file changes.
+    """
+    cached = cache.read_output(path)
+    if cached is not None:
+        return GaudiResults(*cached)
+    results = parse_output(path)
+    cache.write_output(
+        path, results.first_line, results.objectives, results.keys, results.values
+    )
+    return results
+
+
+def parse_output(path):
+    """
+    Parse a .gaudi-output file into a GaudiResults store.
+
+    The YAML event stream is consumed directly so the results mapping
+    never exists as Python objects. Files with an unexpected layout
+    are parsed with the old full ``yaml.safe_load`` code path.
+    """
+    try:
+        return _parse_stream(path)
+    except (yaml.YAMLError, ValueError, KeyError):
+        return _parse_full(path)
+
+
+def write_output(path, first_line, objectives, keys, values):
+    out_data = {}
+    out_data["GAUDI.objectives"] = list(objectives)
+    out_data["GAUDI.results"] = dict(zip(keys, values.tolist()))
+    with open(path, "w") as out:
+        out.write(first_line + "\n")
+        out.write(yaml.safe_dump(out_data, default_flow_style=False))
+
+
+def _parse_full(path):
+    with open(path, "r") as f:
+        first_line = f.readline()
+        raw_data = yaml.safe_load(f)
+    results = raw_data["GAUDI.results"]
+    keys = np.array([sys.intern(key) for key in results], dtype=object)
+    values = np.array(list(results.values()), dtype=float)
+    values = values.reshape(len(keys), len(raw_data["GAUDI.objectives"]))
+    return GaudiResults(first_line, raw_data["GAUDI.objectives"], keys, values)
+
+
+def _parse_stream(path):
+    objectives, keys, columns = None, None, None
+    with open(path, "r") as f:
+        first_line = f.readline()
+        events = yaml.parse(f, Loader=SafeLoader)
+        for event in events:
+            if isinstance(event, yaml.MappingStartEvent):
+                break
+        else:
+            raise ValueError("{} has no top-level mapping".format(path))
+        for event in events:
+            if isinstance(event, yaml.MappingEndEvent):
+                break
+            if not isinstance(event, yaml.ScalarEvent):
+                raise ValueError("Unexpected top-level key in {}".format(path))
+            if event.value == "GAUDI.objectives":
+                objectives = _read_sequence(events)
+            elif event.value == "GAUDI.results":
+                keys, columns = _read_results(events)
+            else:
+                _skip_node(events)
+    if objectives is None or keys is None:
+        raise KeyError("{} is not a GAUDI output".format(path))
+    # Also when every score list is empty, so values are never left unset
+    if keys and len(columns or ()) != len(objectives):
+        raise ValueError("Objectives and results of {} do not match".format(path))
+    keys = np.array(keys, dtype=object)
+    values = np.empty((len(keys), len(objectives)), dtype=float)
+    for i, column in enumerate(columns or ()):
+        values[:, i] = np.frombuffer(column, dtype=float)
+    return GaudiResults(first_line, objectives, keys, values)
+
+
+def _read_sequence(events):
+    if not isinstance(next(events), yaml.SequenceStartEvent):
+        raise ValueError("Expected a sequence")
+    items = []
+    for event in events:
+        if isinstance(event, yaml.SequenceEndEvent):
+            return items
+        if not isinstance(event, yaml.ScalarEvent):
+            raise ValueError("Expected a flat sequence")
+        items.append(event.value)
+
+
+def _read_results(events):
+    if not isinstance(next(events), yaml.MappingStartEvent):
+        raise ValueError("Expected a mapping of results")
+    keys, columns = [], None
+    for event in events:
+        if isinstance(event, yaml.MappingEndEvent):
+            return keys, columns
+        if not isinstance(event, yaml.ScalarEvent):
+            raise ValueError("Expected a result key")
+        keys.append(sys.intern(event.value))
+        if not isinstance(next(events), yaml.SequenceStartEvent):
+            raise ValueError("Expected a list of scores")
+        if columns is None:
+            columns = []
+        i = 0
+        for event in events:
+            if isinstance(event, yaml.SequenceEndEvent):
+                break
+            if not isinstance(event, yaml.ScalarEvent):
+                raise ValueError("Expected a flat list of scores")
+            if i == len(columns):
+                if len(keys) > 1:
+                    raise ValueError("Ragged results")
+                columns.append(array("d"))
+            columns[i].append(_to_float(event.value))
+            i += 1
+        if i != len(columns):
+            raise ValueError("Ragged results")
+
+
+def _skip_node(events):
+    depth = 0
+    for event in events:
+        if isinstance(event, (yaml.MappingStartEvent, yaml.SequenceStartEvent)):
+            depth += 1
+        elif isinstance(event, (yaml.MappingEndEvent, yaml.SequenceEndEvent)):
+            depth -= 1
+        if depth == 0:
+            return
+
+
+_SPECIAL_FLOATS = {".inf": np.inf, "+.inf": np.inf, "-.inf": -np.inf, ".nan": np.nan}
+
+
+def _to_float(text):
+    try:
+        return float(text)
+    except ValueError:
+        return _SPECIAL_FLOATS[text.lower()]
 
 
 class GaudiController(object):
     def __init__(self, session, *args, **kwargs):
         self.session = session
         self.gaudimodel = []
-        self.models = {}
+        settings = get_settings(session)
+        self.models = ModelCache(
+            settings.max_cached_models, settings.max_cached_megabytes * 2 ** 20
+        )
+        self.prefetcher = Prefetcher(self, settings.prefetch_workers)
 
     def add_gaudimodel(self, path):
         self.gaudimodel.append(GaudiModel(self, path, self.session))
 
-    def display(self, key):
+    def gaudimodel_for(self, key):
+        for gm in reversed(self.gaudimodel):
+            if key in gm.keys:
+                return gm
+
+    def zip_path(self, key):
+        return os.path.join(self.gaudimodel_for(key).basedir, key)
 
-        if key in self.models:
-            if not all(
-                i in [actmodel._name for actmodel in self.session.models.list()]
-                for i in [m._name for m in self.models[key]]
-            ):
-                self.session.models.add(self.models[key])
+    def load(self, key):
+        gm = self.gaudimodel_for(key)
+        if gm is not None:
+            gm.parse_zip(key, self.prefetcher.pop(key))
+
+    def prefetch(self, keys):
+        self.prefetcher.prefetch(key for key in keys if key not in self.models)
+
+    def close(self):
+        self.prefetcher.shutdown()
+
+    def display(self, keys, hidden=()):
+        """
+        Hide the solutions of ``hidden`` and display those of ``keys``,
+        with at most one command for each and one call to add the models
+        not opened yet.
+        """
+        models = []
+        for key in hidden:
+            self.models.unpin(key)
+            if key in self.models:
+                models.extend(self.models[key])
+        if models:
+            hide(self.session, models)
+
+        opened = set(actmodel._name for actmodel in self.session.models.list())
+        shown, added = [], []
+        for key in keys:
+            models = self.models.get(key)
+            if models is None:
+                self.load(key)
+                if key not in self.models:
+                    continue
+                added.extend(self.models[key])
+            elif not all(m._name in opened for m in models):
+                added.extend(models)
             else:
-                show(self.session, self.models[key])
+                shown.extend(models)
+            # Pinned right away, so opening the next ones does not close them
+            self.models.pin(key)
+        if added:
+            self.session.models.add(added)
+        if shown:
+            show(self.session, shown)
+        if keys:
+            self.session.logger.status(self.models.summary(), secondary=True)
+
+
+class ModelCache(object):
+    """
+    Opened models of each solution, from least to most recently
+    displayed. Over budget, in number of models or in estimated bytes,
+    the oldest solutions not being displayed are closed; they are
+    opened again the next time they are displayed.
+    """
+
+    BYTES_PER_ATOM = 1024
+
+    def __init__(self, max_models=0, max_bytes=0):
+        self.max_models = max_models
+        self.max_bytes = max_bytes
+        self.hits = self.misses = self.evictions = 0
+        self.n_models = self.n_bytes = 0
+        self._models = OrderedDict()
+        self._bytes = {}
+        self._pinned = set()
+
+    def __contains__(self, key):
+        return key in self._models
+
+    def __getitem__(self, key):
+        return self._models[key]
+
+    def __setitem__(self, key, models):
+        if key in self._models:
+            self._discard(key)
+        self._models[key] = models
+        self._bytes[key] = self.estimate(models)
+        self.n_models += len(models)
+        self.n_bytes += self._bytes[key]
+        self.evict(keep=key)
+
+    def __len__(self):
+        return len(self._models)
+
+    def get(self, key):
+        """Models of a solution, counting the hit or miss."""
+        models = self._models.get(key)
+        if models is not None and any(m.deleted for m in models):
+            # Closed by the user behind our back
+            self._discard(key)
+            models = None
+        if models is None:
+            self.misses += 1
         else:
-            for gm in self.gaudimodel:
-                if key in gm.keys:
-                    gm.parse_zip(key)
-            self.session.models.add(self.models[key])
+            self.hits += 1
+            self._models.move_to_end(key)
+        return models
+
+    def pin(self, key):
+        self._pinned.add(key)
+
+    def unpin(self, key):
+        self._pinned.discard(key)
+
+    def estimate(self, models):
+        return self.BYTES_PER_ATOM * sum(getattr(m, "num_atoms", 0) for m in models)
+
+    def over_budget(self):
+        return (self.max_models and self.n_models > self.max_models) or (
+            self.max_bytes and self.n_bytes > self.max_bytes
+        )
+
+    def evict(self, keep=None):
+        for key in list(self._models):
+            if not self.over_budget():
+                break
+            if key == keep or key in self._pinned:
+                continue
+            close_models(self._discard(key))
+            self.evictions += 1
+
+    def summary(self):
+        return (
+            "GaudiViewX cache: {} solutions ({} models, {:.1f} MB), "
+            "{} hits, {} misses, {} evictions"
+        ).format(
+            len(self._models),
+            self.n_models,
+            self.n_bytes / 2 ** 20,
+            self.hits,
+            self.misses,
+            self.evictions,
+        )
+
+    def _discard(self, key):
+        models = self._models.pop(key)
+        self.n_models -= len(models)
+        self.n_bytes -= self._bytes.pop(key)
+        return models
+
+
+def close_models(models):
+    for m in models:
+        if not m.deleted:
+            if m.id is None:
+                m.delete()
+            else:
+                m.session.models.close([m])
+
+
+class Prefetcher(object):
+    """
+    Reads, and if needed extracts, solution zips on a pool of worker
+    threads ahead of their display, so only the model creation is left
+    to the GUI thread. Requests that are not running yet are dropped as
+    soon as newer ones arrive, and at most ``max_fetched`` results are
+    kept around.
+    """
+
+    def __init__(self, controller, workers=4, max_fetched=64):
+        self.controller = controller
+        self.max_fetched = max_fetched
+        self.executor = ThreadPoolExecutor(max_workers=max(workers, 1))
+        self._futures = OrderedDict()
+
+    def prefetch(self, keys):
+        keys = list(keys)
+        wanted = set(keys)
+        for key, future in list(self._futures.items()):
+            if key not in wanted and future.cancel():
+                del self._futures[key]
+        for key in keys:
+            if key in self._futures:
+                continue
+            gm = self.controller.gaudimodel_for(key)
+            if gm is not None:
+                self._futures[key] = self.executor.submit(gm.fetch, key)
+        while len(self._futures) > self.max_fetched:
+            self._futures.popitem(last=False)[1].cancel()
+
+    def pop(self, key):
+        """Result of GaudiModel.fetch for key, waiting for it if needed."""
+        future = self._futures.pop(key, None)
+        if future is None or future.cancelled():
+            return None
+        try:
+            return future.result()
+        except (OSError, zipfile.BadZipFile):
+            return None
 
-    def not_display(self, key):
-        hide(self.session, self.models[key])
+    def shutdown(self):
+        for future in self._futures.values():
+            future.cancel()
+        self._futures.clear()
+        self.executor.shutdown(wait=False)
 
 
 def show(session, models):
@@ -25,16 +25,23 @@
 
 # Imports
 # Python
-import operator
-import yaml
 import webbrowser
-import copy
+
+import numpy as np
 
 # PyQt5
 from PyQt5.QtGui import QPixmap, QFont
-from PyQt5.QtCore import QAbstractTableModel, QVariant, Qt, pyqtSignal, QModelIndex
+from PyQt5.QtCore import (
+    QAbstractTableModel,
+    QVariant,
+    Qt,
+    pyqtSignal,
+    QModelIndex,
+    QTimer,
+)
 from PyQt5.QtWidgets import (
     QAbstractItemView,
+    QHeaderView,
     QTableView,
     QVBoxLayout,
     QHBoxLayout,
@@ -43,6 +50,18 @@ from PyQt5.QtWidgets import (
 
 # Relative
 from . import gaudireader
+from .store import SolutionStore
+from .settings import get_settings
+from .filtering import combine
+from .history import (
+    History,
+    DeleteRows,
+    FilterRows,
+    SetColumn,
+    SetClusters,
+    AppendRows,
+    ResetView,
+)
 
 
 class TableSkeleton(QTableView):
@@ -66,6 +85,10 @@ class TableSkeleton(QTableView):
         vh = self.verticalHeader()
         vh.setVisible(False)
 
+        # Same height for every row, so no row is ever measured
+        vh.setSectionResizeMode(QHeaderView.Fixed)
+        vh.setDefaultSectionSize(25)
+
         # Set horizontal header properties
         self.hh = self.horizontalHeader()
         self.hh.setHighlightSections(False)
@@ -75,11 +98,6 @@ class TableSkeleton(QTableView):
         # Set column width to fit contents
         self.resizeColumnsToContents()
 
-        # Set row height
-        nrows = len(self.tm.arraydata)
-        for row in range(nrows):
-            self.setRowHeight(row, 25)
-
         # Enable sorting
         self.setSortingEnabled(True)
 
@@ -87,22 +105,66 @@ class TableSkeleton(QTableView):
         self.setSelectionBehavior(QAbstractItemView.SelectRows)
         self.setSelectionMode(QAbstractItemView.ExtendedSelection)
         self.selection = self.selectionModel()
-        self.selection.selectionChanged.connect(self.handle_selection)
-        self.deselection = None
+        self.selection.selectionChanged.connect(self.selection_timer_start)
+        # Keys of the solutions displayed for the current selection
+        self.displayed = []
+
+        # Selecting many rows quickly changes the display just once
+        self.selection_timer = QTimer(self)
+        self.selection_timer.setSingleShot(True)
+        self.selection_timer.setInterval(50)
+        self.selection_timer.timeout.connect(self.handle_selection)
+
+        # Read ahead the solutions around the selection and in view
+        self.prefetch_timer = QTimer(self)
+        self.prefetch_timer.setSingleShot(True)
+        self.prefetch_timer.setInterval(100)
+        self.prefetch_timer.timeout.connect(self.prefetch)
+        self.verticalScrollBar().valueChanged.connect(self.prefetch_timer.start)
+
+    def selection_timer_start(self):
+        self.selection_timer.start()
 
     def handle_selection(self):
-
-        if self.deselection:
-            for model in self.deselection:
-                self.tm.gaudimain.not_display(model)
-
-        selection = [index.data() for index in self.selection.selectedRows()]
-
-        self.deselection = selection
-
-        for model in selection:
-            self.tm.gaudimain.display(model)
+        """
+        Display the newly selected solutions and hide the deselected
+        ones, leaving the rest alone.
+        """
+        store = self.tm.store
+        rows = sorted(index.row() for index in self.selection.selectedRows())
+        selection = store.columns[0][store.rows[rows]].tolist()
+
+        current, previous = set(selection), set(self.displayed)
+        hidden = [key for key in self.displayed if key not in current]
+        shown = [key for key in selection if key not in previous]
+        self.displayed = selection
+        if not hidden and not shown:
+            return
+
+        self.tm.gaudimain.display(shown, hidden)
         self.window.return_pressed()
+        self.prefetch()
+
+    def prefetch(self):
+        """
+        Ask the controller to read ahead the next and previous rows of
+        the current one, nearest first, and then the rows in view.
+        """
+        store = self.tm.store
+        if not len(store):
+            return
+        n = get_settings(self.session).prefetch_rows
+        current = max(self.currentIndex().row(), 0)
+        rows = [current]
+        for i in range(1, n + 1):
+            rows.extend((current + i, current - i))
+        first = max(self.rowAt(0), 0)
+        last = self.rowAt(self.viewport().height() - 1)
+        if last < 0:
+            last = len(store) - 1
+        rows.extend(range(first, last + 1))
+        rows = [row for row in rows if 0 <= row < len(store)]
+        self.tm.gaudimain.prefetch(store.columns[0][store.rows[rows]])
 
 
 class TableModel(QAbstractTableModel):
@@ -110,23 +172,30 @@ class TableModel(QAbstractTableModel):
         QAbstractTableModel.__init__(self, parent, *args)
         self.gaudimain = gaudireader.GaudiController(parent.session)
         self.gaudimain.add_gaudimodel(data)
-        self.arraydata = self.gaudimain.gaudimodel[0].data
-        self.headerdata = self.gaudimain.gaudimodel[0].headers
+        self.store = SolutionStore.from_results(self.gaudimain.gaudimodel[0].results)
+        self.history = History(get_settings(parent.session).undo_megabytes * 2 ** 20)
+
+    @property
+    def clusters(self):
+        """LeaderClusters of the Cluster column shown, if any."""
+        return self.store.clusters
 
-        self.backdoor = copy.deepcopy([self.arraydata, self.headerdata])
+    @property
+    def headerdata(self):
+        return self.store.headers
 
     def rowCount(self, parent):
-        return len(self.arraydata)
+        return len(self.store)
 
     def columnCount(self, parent):
-        return len(self.headerdata)
+        return len(self.store.headers)
 
     def data(self, index, role):
         if not index.isValid():
             return QVariant()
         elif role != Qt.DisplayRole:
             return QVariant()
-        return QVariant(list(self.arraydata)[index.row()][index.column()])
+        return QVariant(self.store.value(index.row(), index.column()))
 
     def headerData(self, col, orientation, role):
         if orientation == Qt.Horizontal and role == Qt.DisplayRole:
@@ -139,30 +208,124 @@ class TableModel(QAbstractTableModel):
         self.order = order
         self.ncol = Ncol
         self.layoutAboutToBeChanged.emit()
-        self.arraydata = sorted(self.arraydata, key=operator.itemgetter(Ncol))
-        if order == Qt.DescendingOrder:
-            self.arraydata.reverse()
+        self.store.sort(Ncol, descending=order == Qt.DescendingOrder)
         self.layoutChanged.emit()
 
+    def append(self, results):
+        """Append the solutions of a GaudiResults, notifying just the new rows."""
+        change = AppendRows(self.store, *self.store.appended(results))
+        self.history.push(change)
+        first, last = len(self.store), len(self.store) + len(change.rows) - 1
+        if last < first:
+            change.apply(self.store)
+            return
+        self.beginInsertRows(QModelIndex(), first, last)
+        change.apply(self.store)
+        self.endInsertRows()
+
+    def reset_store(self, store):
+        """Show another SolutionStore, like the one of a new file, with no history."""
+        self.beginResetModel()
+        self.store = store
+        self.history.clear()
+        self.endResetModel()
+
+    def reset(self):
+        """Show the table as it was loaded, which can be undone."""
+        self.apply(ResetView(self.store))
+
+    def filter(self, expression):
+        """Keep the shown rows matching a filtering expression."""
+        keep = expression.mask(self.store, self.store.rows)
+        filter = combine(self.store.filter, expression)
+        # Rows come and go, so the views are reset
+        self.apply(FilterRows(self.store, keep, filter))
+
+    def apply(self, change):
+        """Do and record a change of the store that resets the views."""
+        self.history.push(change)
+        self.beginResetModel()
+        change.apply(self.store)
+        self.endResetModel()
+
+    def undo(self):
+        if not self.history.undos:
+            return False
+        self.beginResetModel()
+        self.history.undo(self.store)
+        self.endResetModel()
+        return True
+
+    def redo(self):
+        if not self.history.redos:
+            return False
+        self.beginResetModel()
+        self.history.redo(self.store)
+        self.endResetModel()
+        return True
+
+    def set_column(self, header, values, merge=False):
+        """
+        Add, or replace, a column of the store. With ``merge``, replacing
+        the same column again is not another change to undo, as when
+        moving a slider.
+        """
+        self.set(SetColumn(self.store, header, values), merge)
+
+    def set_clusters(self, values, clusters=None, merge=False):
+        """
+        set_column() of Cluster, remembering the LeaderClusters it comes
+        from, if any, until the change is undone.
+        """
+        self.set(SetClusters(self.store, values, clusters), merge)
+
+    def set(self, change, merge=False):
+        top = self.history.top if merge else None
+        if type(top) is type(change) and top.header == change.header:
+            top.merge(change)
+            change = top
+        else:
+            self.history.push(change)
+        if change.header in self.store.headers:
+            col = self.store.headers.index(change.header)
+            change.apply(self.store)
+            self.dataChanged.emit(
+                self.index(0, col), self.index(len(self.store) - 1, col)
+            )
+        else:
+            col = len(self.store.headers)
+            self.beginInsertColumns(QModelIndex(), col, col)
+            change.apply(self.store)
+            self.endInsertColumns()
+
     def removeRows(self, row, rows=1, index=QModelIndex()):
-        self.beginRemoveRows(QModelIndex(), row, row + rows - 1)
-        self.arraydata = self.arraydata[:row] + self.arraydata[row + rows :]
-        self.endRemoveRows()
+        self.remove_rows(range(row, row + rows))
 
         return True
 
+    def remove_rows(self, positions):
+        """Delete the shown rows at ``positions``, contiguous or not."""
+        keep = np.ones(len(self.store), dtype=bool)
+        keep[list(positions)] = False
+        removed = np.flatnonzero(~keep)
+        if not len(removed):
+            return
+        self.history.push(DeleteRows(self.store, keep))
+        # One notification per run of contiguous rows, from the bottom up
+        # so the positions of the runs still to remove do not shift
+        runs = np.split(removed, np.flatnonzero(np.diff(removed) != 1) + 1)
+        for run in reversed(runs):
+            first, last = int(run[0]), int(run[-1])
+            self.beginRemoveRows(QModelIndex(), first, last)
+            self.store.delete(self.store.rows[first : last + 1])
+            self.endRemoveRows()
+
     def write_output(self, path):
-        out_data = {}
-        out_data["GAUDI.objectives"] = self.gaudimain.gaudimodel[0].raw_data[
-            "GAUDI.objectives"
-        ]
-        if "Cluster" in self.headerdata:
-            out_data["GAUDI.results"] = {row[0]: row[1:-1] for row in self.arraydata}
-        else:
-            out_data["GAUDI.results"] = {row[0]: row[1:] for row in self.arraydata}
-        with open(path, "w") as out:
-            out.write(self.gaudimain.gaudimodel[0].first_line + "\n")
-            out.write(yaml.safe_dump(out_data, default_flow_style=False))
+        results = self.gaudimain.gaudimodel[0].results
+        keys, values = self.store.objectives(len(results.objectives))
+        gaudireader.write_output(
+            path, results.first_line, results.objectives, keys, values
+        )
 
 
 class LogoCopyright(QHBoxLayout):
@@ -215,4 +378,3 @@ class QLabelClickable(QLabel):
 
     def mouseReleaseEvent(self, event):
         webbrowser.open("https://www.insilichem.com/")
-
@@ -0,0 +1,241 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+##############
+#   GaudiViewX: UCSF ChimeraX extension to
+#   explore and analyze GaudiMM solutions
+
+#   https://github.com/insilichem/gaudiviewx
+
+#   Copyright 2019 Andrés Giner Antón, Jaime Rodriguez-Guerra
+#   and Jean-Didier Marechal
+
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+
+#        http://www.apache.org/licenses/LICENSE-2.0
+
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+##############
+
+
+# Imports
+# Python
+import numpy as np
+
+
+class History(object):
+    """
+    Changes done to a SolutionStore, to undo and redo them. Each change
+    keeps only what is needed to revert it, like the removed rows or the
+    replaced column, and the oldest ones are forgotten once all of them
+    take more than ``max_bytes``.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.undos = []
+        self.redos = []
+
+    @property
+    def nbytes(self):
+        return sum(change.nbytes for change in self.undos + self.redos)
+
+    @property
+    def top(self):
+        """Last change done, if any and nothing was undone after it."""
+        if self.undos and not self.redos:
+            return self.undos[-1]
+        return None
+
+    def push(self, change):
+        """Record a change that is about to be applied."""
+        self.redos = []
+        self.undos.append(change)
+        nbytes = self.nbytes
+        while nbytes > self.max_bytes and len(self.undos) > 1:
+            nbytes -= self.undos.pop(0).nbytes
+
+    def undo(self, store):
+        if not self.undos:
+            return False
+        change = self.undos.pop()
+        change.revert(store)
+        self.redos.append(change)
+        return True
+
+    def redo(self, store):
+        if not self.redos:
+            return False
+        change = self.redos.pop()
+        change.apply(store)
+        self.undos.append(change)
+        return True
+
+    def clear(self):
+        self.undos = []
+        self.redos = []
+
+
+def _nbytes(*arrays):
+    return sum(array.nbytes for array in arrays if array is not None)
+
+
+class RemoveRows(object):
+    """
+    Removal of the shown rows not in ``keep``, a mask over them. Only
+    the mask, packed, and the stored indices of the removed rows are kept.
+    """
+
+    def __init__(self, store, keep):
+        self.n_rows = len(keep)
+        self.keep = np.packbits(keep)
+        self.removed = store.rows[~keep]
+
+    @property
+    def nbytes(self):
+        return _nbytes(self.keep, self.removed)
+
+    def apply(self, store):
+        # By stored index, as the rows may have been sorted meanwhile
+        removed = np.zeros(store.size, dtype=bool)
+        removed[self.removed] = True
+        store.rows = store.rows[~removed[store.rows]]
+
+    def revert(self, store):
+        keep = np.unpackbits(self.keep, count=self.n_rows).astype(bool)
+        rows = np.empty(self.n_rows, dtype=store.rows.dtype)
+        rows[keep] = store.rows
+        rows[~keep] = self.removed
+        store.rows = rows
+        if store.sort_key is not None:
+            store.sort(*store.sort_key)
+
+
+class DeleteRows(RemoveRows):
+    """RemoveRows that tombstones the removed solutions."""
+
+    def apply(self, store):
+        store.delete(self.removed)
+
+    def revert(self, store):
+        store.undelete(self.removed)
+        super(DeleteRows, self).revert(store)
+
+
+class FilterRows(RemoveRows):
+    """RemoveRows of a filter, replacing the ``filter`` of the store."""
+
+    def __init__(self, store, keep, filter):
+        super(FilterRows, self).__init__(store, keep)
+        self.before = store.filter
+        self.after = filter
+
+    def apply(self, store):
+        super(FilterRows, self).apply(store)
+        store.filter = self.after
+
+    def revert(self, store):
+        super(FilterRows, self).revert(store)
+        store.filter = self.before
+
+
+class SetColumn(object):
+    """Addition, or replacement, of the column ``header``."""
+
+    def __init__(self, store, header, values):
+        self.header = header
+        self.before = None
+        if header in store.headers:
+            self.before = store.columns[store.headers.index(header)]
+        self.after = values
+
+    @property
+    def nbytes(self):
+        return _nbytes(self.before, self.after)
+
+    def merge(self, other):
+        """Take the outcome of ``other``, a later change of the same kind."""
+        self.after = other.after
+
+    def apply(self, store):
+        store.add_column(self.header, self.after)
+
+    def revert(self, store):
+        if self.before is None:
+            store.remove_column(self.header)
+        else:
+            store.add_column(self.header, self.before)
+
+
+class SetClusters(SetColumn):
+    """SetColumn of Cluster, along with the LeaderClusters it comes from."""
+
+    def __init__(self, store, values, clusters=None):
+        super(SetClusters, self).__init__(store, "Cluster", values)
+        self.clusters_before = store.clusters
+        self.clusters_after = clusters
+
+    def merge(self, other):
+        super(SetClusters, self).merge(other)
+        self.clusters_after = other.clusters_after
+
+    def apply(self, store):
+        super(SetClusters, self).apply(store)
+        store.clusters = self.clusters_after
+
+    def revert(self, store):
+        super(SetClusters, self).revert(store)
+        store.clusters = self.clusters_before
+
+
+class AppendRows(object):
+    """
+    Storage of ``blocks``, one per column, after the stored solutions,
+    showing their stored ``rows`` at the end. Only the blocks are kept:
+    the longer columns are built again on redo.
+    """
+
+    def __init__(self, store, blocks, rows):
+        self.size = store.size
+        self.blocks = blocks
+        self.rows = rows
+
+    @property
+    def nbytes(self):
+        return _nbytes(self.rows, *self.blocks)
+
+    def apply(self, store):
+        store.extend(self.blocks, self.rows)
+
+    def revert(self, store):
+        store.truncate(self.size)
+
+
+class ResetView(object):
+    """
+    Reset of the view over the stored solutions. The columns dropped by
+    the reset are kept, not the parsed ones, which stay in the store.
+    """
+
+    def __init__(self, store):
+        self.before = store.copy()
+        self.before.columns = self.before.columns[store.parsed :]
+        self.before._permutations = {}
+
+    @property
+    def nbytes(self):
+        return _nbytes(self.before.rows, self.before.deleted, *self.before.columns)
+
+    def apply(self, store):
+        store.reset()
+
+    def revert(self, store):
+        parsed = store.columns[: store.parsed]
+        store.restore(self.before)
+        store.columns = parsed + store.columns
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+##############
+#   GaudiViewX: UCSF ChimeraX extension to
+#   explore and analyze GaudiMM solutions
+
+#   https://github.com/insilichem/gaudiviewx
+
+#   Copyright 2019 Andrés Giner Antón, Jaime Rodriguez-Guerra
+#   and Jean-Didier Marechal
+
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+
+#        http://www.apache.org/licenses/LICENSE-2.0
+
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+##############
+
+# Imports
+# ChimeraX
+from chimerax.core.settings import Settings
+
+
+class _GaudiViewXSettings(Settings):
+
+    AUTO_SAVE = {
+        # "memory" reads .mol2 members straight from the zip,
+        # "disk" extracts them to a temporary directory first
+        "zip_loading": "memory",
+        # Size cap of the extracted zips shared by every session
+        "extract_cache_megabytes": 512,
+        # Budget of opened solution models, 0 means unlimited
+        "max_cached_models": 200,
+        "max_cached_megabytes": 0,
+        # Solutions read ahead around the selected row, and threads doing it
+        "prefetch_rows": 5,
+        "prefetch_workers": 4,
+        # Threads reading solution coordinates for clustering
+        "coordinate_workers": 4,
+        # Processes computing RMSDs for clustering, 0 means one per core.
+        # More than one forks ChimeraX, so it is opt-in and ignored where
+        # fork is not available
+        "clustering_processes": 1,
+        # Size cap of the pairwise RMSD matrices kept for re-clustering
+        "rmsd_cache_megabytes": 2048,
+        # Memory the changes kept for undo and redo may take
+        "undo_megabytes": 256,
+    }
+
+
+_settings = None
+
+
+def get_settings(session):
+    global _settings
+    if _settings is None:
+        _settings = _GaudiViewXSettings(session, "GaudiViewX")
+    return _settings
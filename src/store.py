@@ -0,0 +1,273 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+##############
+#   GaudiViewX: UCSF ChimeraX extension to
+#   explore and analyze GaudiMM solutions
+
+#   https://github.com/insilichem/gaudiviewx
+
+#   Copyright 2019 Andrés Giner Antón, Jaime Rodriguez-Guerra
+#   and Jean-Didier Marechal
+
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+
+#        http://www.apache.org/licenses/LICENSE-2.0
+
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+##############
+
+# Imports
+# Python
+import numpy as np
+
+
+class SolutionStore(object):
+    """
+    Columnar table of solutions.
+
+    ``columns`` holds one array per header over the stored solutions:
+    the interned filenames first and one float array per objective.
+    They are read-only and never copied: what is shown is a view over
+    them. ``rows`` is the permutation of stored solutions currently
+    shown, so sorting or removing rows never copies the columns, and
+    ``deleted`` is the tombstone bitmap of the deleted solutions.
+    ``filter`` is the expression the shown rows have been filtered
+    with, if any, and it is applied to every appended block as well.
+    ``sort_key`` is the (col, descending) pair of the last sort, if any.
+    ``clusters`` is the LeaderClusters the Cluster column comes from, if
+    any, to put the solutions appended later in the same clusters.
+
+    Sorting permutations of every column are computed once, over all the
+    stored solutions, and shared by copies until a column changes.
+    """
+
+    def __init__(self, headers, columns, rows=None, filter=None, permutations=None):
+        self.headers = list(headers)
+        self.columns = list(columns)
+        for column in self.columns:
+            column.flags.writeable = False
+        if rows is None:
+            rows = np.arange(len(self.columns[0]))
+        self.rows = rows
+        self.deleted = np.zeros(len(self.columns[0]), dtype=bool)
+        self.filter = filter
+        self.sort_key = None
+        self.clusters = None
+        # What reset() shows: the parsed columns of the solutions first stored
+        self.parsed = len(self.headers)
+        self.loaded = len(self.columns[0])
+        # {(col, descending): stored solutions in order, (col, None): ranks}
+        self._permutations = {} if permutations is None else permutations
+
+    @classmethod
+    def from_results(cls, results):
+        columns = [results.keys] + [
+            results.values[:, i] for i in range(results.values.shape[1])
+        ]
+        return cls(results.headers, columns)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __eq__(self, other):
+        if not isinstance(other, SolutionStore):
+            return NotImplemented
+        return (
+            self.headers == other.headers
+            and len(self.columns) == len(other.columns)
+            and all(
+                a is b or np.array_equal(a, b)
+                for a, b in zip(self.columns, other.columns)
+            )
+            and np.array_equal(self.rows, other.rows)
+            and np.array_equal(self.deleted, other.deleted)
+        )
+
+    @property
+    def size(self):
+        """Number of stored solutions, shown or not."""
+        return len(self.columns[0])
+
+    def copy(self):
+        # Columns are never modified in place, so they can be shared
+        store = SolutionStore.__new__(SolutionStore)
+        store.restore(self)
+        return store
+
+    def restore(self, other):
+        """Show what the SolutionStore ``other`` shows, sharing its columns."""
+        self.headers = list(other.headers)
+        self.columns = list(other.columns)
+        self.rows = other.rows.copy()
+        self.deleted = other.deleted.copy()
+        self.filter = other.filter
+        self.sort_key = other.sort_key
+        self.clusters = other.clusters
+        self.parsed = other.parsed
+        self.loaded = other.loaded
+        self._permutations = other._permutations
+
+    def reset(self):
+        """
+        Drop the view: show the solutions first stored, unsorted and
+        unfiltered, with the parsed columns only.
+        """
+        del self.headers[self.parsed :]
+        del self.columns[self.parsed :]
+        self.rows = np.arange(self.loaded)
+        self.deleted = np.zeros(self.size, dtype=bool)
+        self.filter = None
+        self.sort_key = None
+        self.clusters = None
+        self._permutations = {
+            key: order
+            for key, order in self._permutations.items()
+            if key[0] < self.parsed
+        }
+
+    def delete(self, stored):
+        """Tombstone the ``stored`` solutions, hiding them for good."""
+        self.deleted[stored] = True
+        self.rows = self.rows[~self.deleted[self.rows]]
+
+    def undelete(self, stored):
+        self.deleted[stored] = False
+
+    def value(self, row, col):
+        value = self.columns[col][self.rows[row]]
+        if isinstance(value, np.generic):
+            return value.item()
+        return value
+
+    def column(self, col):
+        """Values of column ``col`` in the shown order."""
+        return self.columns[col][self.rows]
+
+    def keys(self):
+        return self.column(0)
+
+    def sort(self, col, descending=False):
+        self.rows = self.ordered([(col, descending)])
+        self.sort_key = (col, descending)
+
+    def ordered(self, keys):
+        """
+        Shown solutions, as stored indices, ordered by ``keys``, a list of
+        (col, descending) pairs with the primary key first. Ties keep the
+        stored order. With one key this just picks the shown solutions
+        from a cached permutation, so no sorting happens at all.
+        """
+        if len(keys) == 1:
+            order = self._permutation(*keys[0])
+            shown = np.zeros(self.size, dtype=bool)
+            shown[self.rows] = True
+            return order[shown[order]]
+        rows = np.sort(self.rows)
+        ranks = [self._ranks(col)[rows] for col, _ in keys]
+        ranks = [-r if descending else r for r, (_, descending) in zip(ranks, keys)]
+        return rows[np.lexsort(ranks[::-1])]
+
+    def _permutation(self, col, descending):
+        key = (col, bool(descending))
+        if key not in self._permutations:
+            if descending:
+                order = np.argsort(-self._ranks(col), kind="mergesort")
+            else:
+                order = np.argsort(self.columns[col], kind="mergesort")
+            self._permutations[key] = order
+        return self._permutations[key]
+
+    def _ranks(self, col):
+        """Rank of each stored value of column ``col``, equal for ties."""
+        if (col, None) not in self._permutations:
+            order = self._permutation(col, False)
+            values = self.columns[col][order]
+            changes = np.empty(len(values), dtype=bool)
+            changes[:1] = True
+            changes[1:] = values[1:] != values[:-1]
+            ranks = np.empty(len(values), dtype=int)
+            ranks[order] = np.cumsum(changes) - 1
+            self._permutations[(col, None)] = ranks
+        return self._permutations[(col, None)]
+
+    def append(self, results):
+        """
+        Store the solutions of another GaudiResults and show those
+        passing the active filter, which only looks at the new block.
+        """
+        self.extend(*self.appended(results))
+
+    def appended(self, results):
+        """
+        What append() adds, without adding it: one block per column with
+        the solutions of a GaudiResults, and the stored rows to show.
+        """
+        blocks = [results.keys] + [
+            results.values[:, i] for i in range(results.values.shape[1])
+        ]
+        for column in self.columns[len(blocks) :]:
+            # Derived columns, like Cluster, are empty for the new block
+            blocks.append(np.zeros(len(results.keys), dtype=column.dtype))
+        rows = np.arange(len(results.keys))
+        if self.filter is not None:
+            rows = rows[self.filter.mask(SolutionStore(self.headers, blocks), rows)]
+        return blocks, self.size + rows
+
+    def extend(self, blocks, rows):
+        """
+        Store ``blocks``, one per column, after the stored solutions, and
+        show their stored ``rows`` after the shown ones.
+        """
+        self.columns = [
+            np.concatenate((column, block))
+            for column, block in zip(self.columns, blocks)
+        ]
+        for column in self.columns:
+            column.flags.writeable = False
+        self._permutations = {}
+        self.rows = np.concatenate((self.rows, rows))
+        self.deleted = np.concatenate(
+            (self.deleted, np.zeros(self.size - len(self.deleted), dtype=bool))
+        )
+
+    def truncate(self, size):
+        """Forget the stored solutions from ``size`` on, undoing extend()."""
+        self.columns = [column[:size] for column in self.columns]
+        self._permutations = {}
+        self.rows = self.rows[self.rows < size]
+        self.deleted = self.deleted[:size]
+
+    def add_column(self, header, values):
+        """Add, or replace, a column with one value per stored solution."""
+        values.flags.writeable = False
+        if header in self.headers:
+            col = self.headers.index(header)
+            self.columns[col] = values
+        else:
+            col = len(self.headers)
+            self.headers.append(header)
+            self.columns.append(values)
+        # Copies may share the cache, so it is replaced, not modified
+        self._permutations = {
+            key: order for key, order in self._permutations.items() if key[0] != col
+        }
+
+    def remove_column(self, header):
+        col = self.headers.index(header)
+        del self.headers[col]
+        del self.columns[col]
+        self._permutations = {}
+        if self.sort_key is not None and self.sort_key[0] >= col:
+            self.sort_key = None
+
+    def objectives(self, n_objectives):
+        """Keys and (rows, objectives) scores of the shown solutions."""
+        values = np.column_stack(self.columns[1 : n_objectives + 1])[self.rows]
+        return self.keys(), values
@@ -25,10 +25,10 @@
 
 # Imports
 # Python
-import yaml
-import copy
 import os
 
+import numpy as np
+
 # ChimeraX
 from chimerax.core.tools import ToolInstance
 from chimerax.ui import MainToolWindow
@@ -49,7 +49,8 @@ from PyQt5.QtWidgets import (
 )
 
 # Relative
-from . import gui, toolbar
+from . import cache, gaudireader, gui, toolbar
+from .settings import get_settings
 
 # Resource
 QResource.registerResource(
@@ -86,16 +87,16 @@ class GaudiViewXTool(ToolInstance):
         if self.path:
 
             self.table = gui.TableSkeleton(self)
-            main_layout.addWidget(toolbar.MyToolBar(self))
+            self.tool_bar = toolbar.MyToolBar(self)
+            main_layout.addWidget(self.tool_bar)
             hbox = QHBoxLayout()
 
             hbox.addWidget(self.table)
 
-            # Undo
-            self.data_save0, self.data_save1, self.data_save2, self.data_save3, self.data_save4 = [
-                copy.deepcopy([self.table.tm.arraydata, self.table.tm.headerdata])
-                for i in range(5)
-            ]
+            # Assigns added solutions to the clusters on a worker thread,
+            # and the solutions added while it runs after it, in order
+            self.assignment = None
+            self.pending_assignments = []
 
             # Box bottons
             box_layout = QVBoxLayout()
@@ -121,6 +122,11 @@ class GaudiViewXTool(ToolInstance):
             undo_butn.setFont(QFont("Helvetica", 12))
             box_layout.addWidget(undo_butn)
 
+            redo_butn = QPushButton("Redo")
+            redo_butn.clicked.connect(self.redo)
+            redo_butn.setFont(QFont("Helvetica", 12))
+            box_layout.addWidget(redo_butn)
+
             box_layout.addSpacing(25)
 
             reset_butn = QPushButton("RESET")
@@ -160,9 +166,22 @@ class GaudiViewXTool(ToolInstance):
 
             self.tool_window.destroy()
 
+    def delete(self):
+        if hasattr(self, "table"):
+            self.pending_assignments = []
+            if self.assignment is not None:
+                self.assignment.cancel()
+                self.assignment.wait()
+            if self.tool_bar.clustering_box is not None:
+                self.tool_bar.clustering_box.stop()
+            self.table.tm.gaudimain.close()
+        cache.extraction_cache(
+            get_settings(self.session).extract_cache_megabytes * 2 ** 20
+        ).prune()
+        super().delete()
+
     def add_new_data(self):
 
-        self.update_saves()
         options = QFileDialog.Options()
         options |= QFileDialog.DontUseNativeDialog
         name_file, _ = QFileDialog.getOpenFileName(
@@ -173,17 +192,18 @@ class GaudiViewXTool(ToolInstance):
             options=options,
         )
         if name_file:
-            if equal_objectives(name_file) == self.table.tm.headerdata:
+            objectives = [h for h in self.table.tm.headerdata if h != "Cluster"]
+            if equal_objectives(name_file) == objectives:
                 self.table.tm.gaudimain.add_gaudimodel(name_file)
-                self.table.tm.layoutAboutToBeChanged.emit()
-                self.table.tm.arraydata = (
-                    self.table.tm.arraydata
-                    + self.table.tm.gaudimain.gaudimodel[-1].data
-                )
-                self.table.tm.layoutChanged.emit()
-                nrows = len(self.table.tm.arraydata)
-                for row in range(nrows):
-                    self.table.setRowHeight(row, 25)
+                start = self.table.tm.store.size
+                self.table.tm.append(self.table.tm.gaudimain.gaudimodel[-1].results)
+                stored = np.arange(start, self.table.tm.store.size)
+                if (
+                    len(stored)
+                    and self.table.tm.clusters is not None
+                    and "Cluster" in self.table.tm.headerdata
+                ):
+                    self.assign_clusters(stored)
             else:
                 mesbox = QMessageBox()
                 mesbox.setIcon(QMessageBox.Warning)
@@ -193,15 +213,70 @@ class GaudiViewXTool(ToolInstance):
                 mesbox.setStandardButtons(QMessageBox.Ok)
                 mesbox.exec()
 
+    def assign_clusters(self, stored, clusters=None):
+        """
+        Put the ``stored`` solutions in the clusters of the last leader
+        clustering, or in new ones, without clustering the rest again.
+        While another assignment runs they wait for it, without blocking,
+        and then extend the ``clusters`` it extended.
+        """
+        tm = self.table.tm
+        if self.assignment is not None:
+            self.pending_assignments.append(stored)
+            return
+        if clusters is None:
+            clusters = tm.clusters
+        if clusters is None or tm.store.size <= stored[-1]:
+            return
+        keys = tm.store.columns[0][stored]
+        worker = toolbar.AssignmentWorker(
+            [tm.gaudimain.zip_path(key) for key in keys],
+            clusters,
+            get_settings(self.session),
+        )
+        gaudimain = tm.gaudimain
+
+        def assigned(result):
+            labels, extended = result
+            # Dropped if the table changed meanwhile, like by an undo
+            if (
+                tm.gaudimain is not gaudimain
+                or tm.clusters is not clusters
+                or "Cluster" not in tm.headerdata
+                or tm.store.size <= stored[-1]
+                or not np.array_equal(tm.store.columns[0][stored], keys)
+            ):
+                return
+            cluster_ids = tm.store.columns[tm.headerdata.index("Cluster")].copy()
+            cluster_ids[stored] = labels + 1
+            tm.set_clusters(cluster_ids, extended)
+            self.session.logger.status(
+                "{} solutions added to {} clusters".format(len(stored), len(extended))
+            )
+
+        def failed(message):
+            self.session.logger.warning(
+                "The added solutions could not be clustered: {}".format(message)
+            )
+
+        def finished():
+            if self.assignment is not worker:
+                return
+            self.assignment = None
+            if tm.gaudimain is not gaudimain:
+                self.pending_assignments = []
+            while self.pending_assignments and self.assignment is None:
+                self.assign_clusters(self.pending_assignments.pop(0), worker.extended)
+
+        worker.clustered.connect(assigned)
+        worker.failed.connect(failed)
+        worker.finished.connect(finished)
+        self.assignment = worker
+        worker.start()
+
     def reset_changes(self):
 
-        self.update_saves()
-        self.table.tm.layoutAboutToBeChanged.emit()
-        self.table.tm.arraydata, self.table.tm.headerdata = self.table.tm.backdoor
-        self.table.tm.layoutChanged.emit()
-        nrows = len(self.table.tm.arraydata)
-        for row in range(nrows):
-            self.table.setRowHeight(row, 25)
+        self.table.tm.reset()
 
     def activate_delete_button(self, selected):
         if self.delete_butn.isEnabled() == False:
@@ -209,51 +284,22 @@ class GaudiViewXTool(ToolInstance):
 
     def remove_selected_rows(self):
 
-        self.update_saves()
         indexes = self.table.selectionModel().selectedRows()
-        self.table.tm.removeRows(indexes[0].row(), len(indexes))
+        self.table.tm.remove_rows([index.row() for index in indexes])
         self.delete_butn.setEnabled(False)
 
     def undo(self):
 
-        self.table.tm.layoutAboutToBeChanged.emit()
-
-        if [self.table.tm.arraydata, self.table.tm.headerdata] == self.data_save4:
-            return
-        elif [self.table.tm.arraydata, self.table.tm.headerdata] == self.data_save3:
-            self.table.tm.arraydata, self.table.tm.headerdata = self.data_save4
-        elif [self.table.tm.arraydata, self.table.tm.headerdata] == self.data_save2:
-            self.table.tm.arraydata, self.table.tm.headerdata = self.data_save3
-        elif [self.table.tm.arraydata, self.table.tm.headerdata] == self.data_save1:
-            self.table.tm.arraydata, self.table.tm.headerdata = self.data_save2
-        elif [self.table.tm.arraydata, self.table.tm.headerdata] == self.data_save0:
-            self.table.tm.arraydata, self.table.tm.headerdata = self.data_save1
-        else:
-            self.table.tm.arraydata, self.table.tm.headerdata = self.data_save0
-        self.table.tm.layoutChanged.emit()
+        self.table.tm.undo()
 
-        nrows = len(self.table.tm.arraydata)
-        for row in range(nrows):
-            self.table.setRowHeight(row, 25)
+    def redo(self):
 
-    def update_saves(self):
-
-        self.data_save4 = copy.deepcopy(self.data_save3)
-        self.data_save3 = copy.deepcopy(self.data_save2)
-        self.data_save2 = copy.deepcopy(self.data_save1)
-        self.data_save1 = copy.deepcopy(self.data_save0)
-        self.data_save0 = copy.deepcopy(
-            [self.table.tm.arraydata, self.table.tm.headerdata]
-        )
+        self.table.tm.redo()
 
     def return_pressed(self):
         run(self.session, "%s" % self.line_edit.text())
 
 
 def equal_objectives(path):
-    with open(path, "r") as f:
-        data = yaml.safe_load(f)
-    header = ["Filename"] + list(
-        map(lambda text: text.split()[0], data["GAUDI.objectives"])
-    )
-    return header
+    # Goes through the parsed-output cache, so add_gaudimodel reuses it
+    return gaudireader.load_output(path).headers
@@ -25,15 +25,17 @@
 
 # Imports
 # Python
-import operator
-import copy
+import zipfile
+import time
+import os
+
+import numpy as np
 
 # ChimeraX
-from chimerax.core.geometry import align_points
 from chimerax.core.commands import run
 
 # PyQt5
-from PyQt5.QtCore import Qt, pyqtSignal, QResource
+from PyQt5.QtCore import Qt, pyqtSignal, QResource, QThread
 from PyQt5.QtGui import QIcon, QPixmap
 from PyQt5.QtWidgets import (
     QVBoxLayout,
@@ -48,16 +50,31 @@ from PyQt5.QtWidgets import (
     QLabel,
     QComboBox,
     QRadioButton,
+    QCheckBox,
     QDoubleSpinBox,
     QButtonGroup,
     QProgressDialog,
     QScrollArea,
     QFrame,
+    QMessageBox,
+    QLineEdit,
+    QSlider,
 )
 
 # Relative
-from . import gaudireader, gui
-
+from . import cache, gaudireader, gui
+from .store import SolutionStore
+from .filtering import Condition, And, Or
+from .coordinates import AtomSelection, load_coordinates
+from .clustering import (
+    MatrixRMSD,
+    Dendrogram,
+    LeaderClusters,
+    leader_clustering,
+    pairwise_rmsd,
+    rmsd_kernel,
+)
+from .settings import get_settings
 
 
 class MyToolBar(QToolBar):
@@ -67,6 +84,7 @@ class MyToolBar(QToolBar):
         self.window = window
         self.table = window.table
         self.session = window.session
+        self.clustering_box = None
         self.addAction(QAction(QIcon(":/icons/open.png"), "Open", self))
         self.addAction(QAction(QIcon(":/icons/save.png"), "Save", self))
         self.addSeparator()
@@ -120,7 +138,16 @@ class MyToolBar(QToolBar):
         elif action.text() == "Filter":
             FilterBox(self)
         elif action.text() == "Clustering":
-            ClusteringBox(self)
+            # Not modal: ChimeraX stays usable while clustering runs
+            box = self.clustering_box
+            if box is not None and (box.worker is not None or box.isVisible()):
+                box.show()
+                box.raise_()
+                box.activateWindow()
+            else:
+                if box is not None:
+                    box.close()
+                self.clustering_box = ClusteringBox(self)
         elif action.text() == "Help":
             self.window.display_help()
 
@@ -137,24 +164,17 @@ class MyToolBar(QToolBar):
 
         if name_file:
             from . import gui
-            self.window.update_saves()
-            self.table.tm.layoutAboutToBeChanged.emit()
-            self.table.tm.removeRows(0, len(self.table.tm.arraydata))
+            self.table.tm.gaudimain.close()
             self.table.tm.gaudimain = gaudireader.GaudiController(self.session)
             self.table.tm.gaudimain.add_gaudimodel(name_file)
-            self.table.tm.arraydata = self.table.tm.gaudimain.gaudimodel[0].data
-            self.table.tm.headerdata = self.table.tm.gaudimain.gaudimodel[0].headers
+            self.table.tm.reset_store(
+                SolutionStore.from_results(
+                    self.table.tm.gaudimain.gaudimodel[0].results
+                )
+            )
             self.window.delete_butn.setEnabled(False)
-            self.table.tm.layoutChanged.emit()
-            nrows = len(self.table.tm.arraydata)
-            for row in range(nrows):
-                self.table.setRowHeight(row, 25)
             run(self.session, "close session")
 
-            self.backdoor = copy.deepcopy(
-                [self.table.tm.arraydata, self.table.tm.headerdata]
-            )
-
 
 class FilterBox(QDialog):
     def __init__(self, toolbar, parent=None, *args):
@@ -214,7 +234,6 @@ class FilterBox(QDialog):
         self.widgets.append(new)
 
     def run_filter(self):
-        self.toolbar.window.update_saves()
         filter_conditions = [[]]
         index = 0
         w = self.widgets.pop(0)
@@ -247,95 +266,16 @@ class FilterBox(QDialog):
                     ]
                 )
 
-        filtered_array = []
-        for condition in filter_conditions:
-            conditional_array = copy.deepcopy(self.toolbar.table.tm.arraydata)
-            for w in condition:
-                index = self.toolbar.table.tm.headerdata.index(w[0])
-                if w[1] == ">":
-                    conditional_array = greater(index, conditional_array, w[2])
-                elif w[1] == "<":
-                    conditional_array = lesser(index, conditional_array, w[2])
-                elif w[1] == "=":
-                    conditional_array = equal(index, conditional_array, w[2])
-                elif w[1] == "≥":
-                    conditional_array = greater_equal(index, conditional_array, w[2])
-                elif w[1] == "≤":
-                    conditional_array = lesser_equal(index, conditional_array, w[2])
-                elif w[1] == "≠":
-                    conditional_array = not_equal(index, conditional_array, w[2])
-            filtered_array.extend(conditional_array)
-
-        unique = []
-        for row in filtered_array:
-            if not row in unique:
-                unique.append(row)
-
-        self.toolbar.table.tm.arraydata = unique
-        self.toolbar.table.tm.layoutChanged.emit()
+        expression = Or(
+            *[
+                And(*[Condition(*w) for w in condition])
+                for condition in filter_conditions
+            ]
+        )
+        self.toolbar.table.tm.filter(expression)
         self.hide()
 
 
-def greater(index, array, threshold):
-    new_array = []
-    for row in array:
-        if float(row[index]) > threshold:
-            new_array.append(row)
-    array = new_array
-
-    return array
-
-
-def greater_equal(index, array, threshold):
-    new_array = []
-    for row in array:
-        if not float(row[index]) < threshold:
-            new_array.append(row)
-    array = new_array
-
-    return array
-
-
-def equal(index, array, threshold):
-    new_array = []
-    for row in array:
-        if float(row[index]) == threshold:
-            new_array.append(row)
-    array = new_array
-
-    return array
-
-
-def not_equal(index, array, threshold):
-    new_array = []
-    for row in array:
-        if float(row[index]) != threshold:
-            new_array.append(row)
-    array = new_array
-
-    return array
-
-
-def lesser(index, array, threshold):
-    new_array = []
-    for row in array:
-        if float(row[index]) < threshold:
-            new_array.append(row)
-    array = new_array
-
-    return array
-
-
-def lesser_equal(index, array, threshold):
-    new_array = []
-    for row in array:
-        if not float(row[index]) > threshold:
-            new_array.append(row)
-    array = new_array
-
-    return array
-
-
 class FilterCondition(QFrame):
     def __init__(self, toolbar, widgets, first=False, parent=None, *args):
         self.toolbar = toolbar
@@ -468,9 +408,10 @@ class ClusteringBox(QDialog):
         self.toolbar = toolbar
         self.obj_sel = self.toolbar.table.tm.headerdata[self.toolbar.table.tm.ncol]
         self.order = self.toolbar.table.tm.order
+        self.worker = None
         self.setLayout(self.init_ui())
         self.setFixedSize(self.minimumSize())
-        self.exec()
+        self.show()
 
     def init_ui(self):
         self.vbox = QVBoxLayout()
@@ -508,6 +449,61 @@ class ClusteringBox(QDialog):
         hbox.addWidget(self.rmsd_box)
         self.vbox.addLayout(hbox)
 
+        hbox = QHBoxLayout()
+        hbox.addWidget(QLabel("Calculated"))
+        self.mode_box = QComboBox()
+        self.mode_box.addItems(["After superposition", "In place"])
+        self.mode_box.currentIndexChanged.connect(self.mode_changed)
+        hbox.addWidget(self.mode_box)
+        self.vbox.addLayout(hbox)
+
+        self.symmetry_box = QCheckBox("Match symmetry-equivalent atoms")
+        self.symmetry_box.setEnabled(False)
+        self.vbox.addWidget(self.symmetry_box)
+
+        hbox = QHBoxLayout()
+        hbox.addWidget(QLabel("Over"))
+        self.atoms_box = QComboBox()
+        self.atoms_box.addItem("All atoms", AtomSelection("all"))
+        self.atoms_box.addItem("The ligand", AtomSelection("ligand"))
+        for label in self.molecule_labels():
+            self.atoms_box.addItem(
+                "{} atoms".format(label), AtomSelection("molecule", label)
+            )
+        self.atoms_box.addItem("Atom spec", None)
+        self.atoms_box.currentIndexChanged.connect(self.atoms_changed)
+        hbox.addWidget(self.atoms_box)
+        self.spec_box = QLineEdit()
+        self.spec_box.setPlaceholderText(":LIG@C*")
+        self.spec_box.setEnabled(False)
+        hbox.addWidget(self.spec_box)
+        self.vbox.addLayout(hbox)
+
+        self.matrix_box = QCheckBox("Keep all the RMSDs to cluster again at once")
+        self.vbox.addWidget(self.matrix_box)
+
+        hbox = QHBoxLayout()
+        hbox.addWidget(QLabel("Joining solutions by"))
+        self.linkage_box = QComboBox()
+        self.linkage_box.addItem("Their cluster leader", None)
+        for method in Dendrogram.METHODS:
+            self.linkage_box.addItem("{} linkage".format(method.capitalize()), method)
+        hbox.addWidget(self.linkage_box)
+        self.vbox.addLayout(hbox)
+
+        # Cuts the dendrogram of hierarchical clustering once it is built
+        hbox = QHBoxLayout()
+        hbox.addWidget(QLabel("Cut at"))
+        self.cut_slider = QSlider(Qt.Horizontal)
+        self.cut_slider.setEnabled(False)
+        self.cut_slider.valueChanged.connect(self.cut_dendrogram)
+        hbox.addWidget(self.cut_slider)
+        self.cut_label = QLabel("-")
+        self.cut_label.setMinimumWidth(50)
+        hbox.addWidget(self.cut_label)
+        self.vbox.addLayout(hbox)
+        self.dendrogram = None
+
         self.run_butn = QPushButton("Cluster!")
         self.run_butn.clicked.connect(self.run_clustering)
         self.run_butn.setFixedSize(100, 30)
@@ -519,99 +515,380 @@ class ClusteringBox(QDialog):
 
         return self.vbox
 
+    def molecule_labels(self):
+        """Names of the molecules of the first solution, as in Ligand_1.mol2."""
+        tm = self.toolbar.table.tm
+        try:
+            path = tm.gaudimain.zip_path(tm.store.value(0, 0))
+            with zipfile.ZipFile(path) as z:
+                members = gaudireader.mol2_members(z)
+        except (IndexError, OSError, zipfile.BadZipFile):
+            return []
+        labels = []
+        for member in members:
+            label = os.path.splitext(os.path.basename(member))[0].split("_")[0]
+            if label not in labels:
+                labels.append(label)
+        return labels
+
+    def atoms_changed(self, index):
+        self.spec_box.setEnabled(self.atoms_box.currentData() is None)
+
+    def mode_changed(self, index):
+        # Symmetric matching is only meaningful without superposition
+        self.symmetry_box.setEnabled(self.mode_box.currentText() == "In place")
+
     def run_clustering(self):
 
-        self.toolbar.window.update_saves()
-        save = copy.deepcopy(
-            [self.toolbar.table.tm.arraydata, self.toolbar.table.tm.headerdata]
-        )
+        if self.worker is not None:
+            return
+        store = self.toolbar.table.tm.store
         order = self.toogle_bar.activated
         objective = self.bbox.checkedButton().text()
-        sorted(
-            self.toolbar.table.tm.arraydata,
-            key=operator.itemgetter(self.toolbar.table.tm.headerdata.index(objective)),
+        # Best solutions first, so they lead their clusters
+        rows = store.ordered([(store.headers.index(objective), order == "max")])
+
+        selection = self.atoms_box.currentData()
+        if selection is None:
+            selection = AtomSelection("spec", self.spec_box.text())
+        in_place = self.mode_box.currentText() == "In place"
+
+        # Clusters are applied to the same stored solutions when done, so
+        # the table can be sorted, filtered or extended meanwhile; if an
+        # undo drops any of them, the clusters are discarded
+        self.gaudimain = self.toolbar.table.tm.gaudimain
+        self.cut_rows = rows
+        self.cut_keys = store.columns[0][rows]
+        self.worker = ClusteringWorker(
+            [self.gaudimain.zip_path(key) for key in store.columns[0][rows]],
+            self.rmsd_box.value(),
+            selection,
+            in_place,
+            in_place and self.symmetry_box.isChecked(),
+            method=self.linkage_box.currentData(),
+            keep=self.matrix_box.isChecked(),
+            settings=get_settings(self.toolbar.session),
         )
-        if order == "max":
-            self.toolbar.table.tm.arraydata.reverse()
-
-        rmsd_value = self.rmsd_box.value()
-        solutions = []
-
-        count = 0
-        progress = QProgressDialog(
-            "Loading the solutions...",
-            "Cancel",
-            count,
-            len(self.toolbar.table.tm.arraydata) * 2,
+        self.worker.progressed.connect(self.show_progress)
+        self.worker.clustered.connect(self.clustering_done)
+        self.worker.failed.connect(self.clustering_failed)
+        self.worker.warned.connect(self.toolbar.session.logger.warning)
+        self.worker.finished.connect(self.worker_finished)
+
+        self.progress = QProgressDialog("Loading the solutions...", "Cancel", 0, 0)
+        self.progress.setFixedWidth(300)
+        self.progress.setWindowTitle("Clustering Progress")
+        self.progress.setAutoClose(False)
+        self.progress.setAutoReset(False)
+        self.progress.canceled.connect(self.worker.cancel)
+        self.progress.show()
+        self.run_butn.setEnabled(False)
+        self.worker.start()
+
+    def show_progress(self, label, done, total):
+        self.progress.setLabelText(label)
+        self.progress.setMaximum(total)
+        self.progress.setValue(done)
+
+    def clustering_done(self, result):
+        if self.worker.method is not None:
+            # Built once, then the slider cuts it at any RMSD
+            self.dendrogram, self.cut_order = result
+            self.cut_saved = False
+            self.cut_slider.blockSignals(True)
+            self.cut_slider.setRange(0, int(np.ceil(self.dendrogram.height * 100)))
+            self.cut_slider.setValue(int(round(self.worker.cutoff * 100)))
+            self.cut_slider.blockSignals(False)
+            self.cut_slider.setEnabled(True)
+            self.cut_dendrogram(self.cut_slider.value())
+            return
+        labels, leaders, stats, clusters = result
+        # Clusters kept to assign the solutions added later to them
+        if self.apply_clusters(labels, clusters=clusters):
+            self.toolbar.session.logger.info(
+                "{} solutions in {} clusters: {} RMSD calculated, {} skipped "
+                "by their lower bounds".format(
+                    len(labels), len(leaders), stats["evaluated"], stats["skipped"]
+                )
+            )
+            self.hide()
+
+    def clustering_failed(self, message):
+        self.progress.close()
+        mesbox = QMessageBox()
+        mesbox.setIcon(QMessageBox.Warning)
+        mesbox.setText("The solutions could not be clustered: {}".format(message))
+        mesbox.setStandardButtons(QMessageBox.Ok)
+        mesbox.exec()
+
+    def worker_finished(self):
+        self.progress.close()
+        self.worker = None
+        self.run_butn.setEnabled(True)
+
+    def apply_clusters(self, labels, save=True, clusters=None):
+        """
+        Set the Cluster column of the clustered solutions, and the
+        LeaderClusters they come from, if any, in a single model
+        notification, as a change of its own to undo if ``save``.
+        Returns False if the table was replaced, or the clustered
+        solutions dropped, meanwhile.
+        """
+        tm = self.toolbar.table.tm
+        if (
+            tm.gaudimain is not self.gaudimain
+            or (len(self.cut_rows) and tm.store.size <= self.cut_rows.max())
+            or not np.array_equal(tm.store.columns[0][self.cut_rows], self.cut_keys)
+        ):
+            self.toolbar.session.logger.warning(
+                "The table changed, so the clusters were discarded"
+            )
+            return False
+        cluster_ids = np.zeros(tm.store.size, dtype=int)
+        cluster_ids[self.cut_rows] = labels + 1
+        tm.set_clusters(cluster_ids, clusters, merge=not save)
+        return True
+
+    def cut_dendrogram(self, value):
+        """Show the clusters of the dendrogram cut at ``value`` hundredths of A."""
+        if self.dendrogram is None:
+            return
+        cutoff = value / 100
+        self.cut_label.setText("{:.2f} \u212b".format(cutoff))
+        # Moving the slider around is a single action to undo
+        labels = self.dendrogram.cut(cutoff, self.cut_order)
+        if not self.apply_clusters(labels, save=not self.cut_saved):
+            self.dendrogram = None
+            self.cut_slider.setEnabled(False)
+        self.cut_saved = True
+
+    def stop(self):
+        """Cancel the running clustering, if any, and wait for it."""
+        if self.worker is not None:
+            self.worker.cancel()
+            self.worker.wait()
+
+    def closeEvent(self, event):
+        self.stop()
+        super(ClusteringBox, self).closeEvent(event)
+
+
+class ClusteringWorker(QThread):
+    """
+    Clusters the solutions in ``paths`` away from the GUI thread, by
+    their leaders or, with a linkage ``method``, as a Dendrogram. Progress
+    is reported at most every PROGRESS_INTERVAL seconds, and cancel()
+    stops the running step at its next progress report.
+    """
+
+    PROGRESS_INTERVAL = 0.1
+    progressed = pyqtSignal(str, int, int)
+    clustered = pyqtSignal(object)
+    failed = pyqtSignal(str)
+    warned = pyqtSignal(str)
+
+    def __init__(
+        self,
+        paths,
+        cutoff,
+        selection,
+        in_place,
+        symmetric,
+        method=None,
+        keep=False,
+        settings=None,
+        parent=None,
+    ):
+        super(ClusteringWorker, self).__init__(parent)
+        self.paths = paths
+        self.cutoff = cutoff
+        self.selection = selection
+        self.in_place = in_place
+        self.symmetric = symmetric
+        self.method = method
+        self.keep = keep
+        self.settings = settings
+        self.cancelled = False
+        self.coordinates = None
+        # Position of each of ``paths`` in coordinates, if not the same
+        self.positions = None
+        self._label, self._total, self._last = "", 0, 0.0
+
+    def cancel(self):
+        self.cancelled = True
+
+    def run(self):
+        try:
+            result = self.cluster()
+        except (OSError, zipfile.BadZipFile, ValueError) as e:
+            if not self.cancelled:
+                self.failed.emit(str(e))
+            return
+        if result is not None and not self.cancelled:
+            self.clustered.emit(result)
+
+    def cluster(self):
+        if self.method is not None or self.keep:
+            matrix = self.rmsd_matrix()
+            if matrix is None:
+                return None
+            rmsd = MatrixRMSD(*matrix)
+        else:
+            rmsd = self.rmsd_kernel(self.paths)
+            if rmsd is None:
+                return None
+        if self.method is not None:
+            self.phase("Building the dendrogram...", 0)
+            return Dendrogram(rmsd.matrix, self.method), rmsd.order
+        self.phase("Clustering...", len(self.paths))
+        processes = self.settings.clustering_processes
+        clusters = leader_clustering(
+            rmsd,
+            self.cutoff,
+            progress=self.step,
+            processes=processes or os.cpu_count() or 1,
+        )
+        if clusters is None:
+            return None
+        labels, leaders, stats = clusters
+        kept = self.leader_clusters(leaders)
+        if kept is None:
+            return None
+        return labels, leaders, stats, kept
+
+    def phase(self, label, total):
+        self._label, self._total, self._last = label, total, time.monotonic()
+        self.progressed.emit(label, 0, total)
+
+    def step(self, done):
+        now = time.monotonic()
+        if now - self._last >= self.PROGRESS_INTERVAL:
+            self._last = now
+            self.progressed.emit(self._label, done, self._total)
+        return not self.cancelled
+
+    def rmsd_kernel(self, paths):
+        """RMSD kernel over the solutions in ``paths``, or None if cancelled."""
+        # Read the coordinates straight from the zips, opening no models
+        self.phase("Loading the solutions...", len(paths))
+        self.coordinates = load_coordinates(
+            paths,
+            self.settings.coordinate_workers,
+            progress=self.step,
+            selection=self.selection,
+        )
+        if self.coordinates is None:
+            return None
+        return rmsd_kernel(self.coordinates, self.in_place, self.symmetric)
+
+    def leader_clusters(self, leaders):
+        """LeaderClusters of the ``leaders`` found, or None if cancelled."""
+        if self.coordinates is not None:
+            coordinates = self.coordinates
+            if self.positions is not None:
+                leaders = np.asarray(self.positions)[leaders]
+            coordinates.coords = coordinates.coords[leaders]
+        else:
+            # Distances came from the matrix cache: read just the leaders
+            self.phase("Loading the cluster leaders...", len(leaders))
+            coordinates = load_coordinates(
+                [self.paths[i] for i in leaders],
+                self.settings.coordinate_workers,
+                progress=self.step,
+                selection=self.selection,
+            )
+            if coordinates is None:
+                return None
+        return LeaderClusters(
+            coordinates, self.cutoff, self.selection, self.in_place, self.symmetric
         )
-        progress.setFixedWidth(300)
-        progress.setWindowTitle("Clustering Progress")
-        progress.setWindowModality(Qt.WindowModal)
-
-        progress.forceShow()
-
-        for row in self.toolbar.table.tm.arraydata:
-            if progress.isVisible() == False:
-                break
-            count += 1
-            progress.setValue(count)
-            if not row[0] in self.toolbar.table.tm.gaudimain.models:
-                for gm in self.toolbar.table.tm.gaudimain.gaudimodel:
-                    if row[0] in gm.keys:
-                        gm.parse_zip(row[0])
-            solutions.append((row[0], self.toolbar.table.tm.gaudimain.models[row[0]]))
-        clusters = [[]]
-
-        self.toolbar.table.tm.layoutAboutToBeChanged.emit()
-
-        if not "Cluster" in self.toolbar.table.tm.headerdata:
-            self.toolbar.table.tm.headerdata.append("Cluster")
-        index_cluster = self.toolbar.table.tm.headerdata.index("Cluster")
-
-        clusters[0].append(solutions.pop(0))
-
-        progress.setLabelText("Calculating RMSD...")
-        while solutions:
-            if progress.isVisible() == False:
-                self.toolbar.table.tm.arraydata, self.toolbar.table.tm.headerdata = save
-                break
-            next_sol = solutions.pop(0)
-            count += 1
-            progress.setValue(count)
-            for cluster in clusters:
-                rmsd = calculate_rmsd(cluster[0][1], next_sol[1], rmsd_value)
-                if rmsd < rmsd_value:
-                    cluster.append(next_sol)
-                    break
-            else:
-                clusters.append([next_sol])
-
-        progress.setLabelText("DONE")
-
-        for index, cluster in enumerate(clusters):
-            for key, models in cluster:
-                for row in self.toolbar.table.tm.arraydata:
-                    if row[0] == key:
-                        row.insert(index_cluster, index + 1)
-
-        self.toolbar.table.tm.layoutChanged.emit()
-
-        progress.close()
-        self.hide()
-
-
-def calculate_rmsd(ref_models, to_models, cutoff):
 
-    if isinstance(ref_models, list) and isinstance(to_models, list):
-        for ref_model, to_model in zip(ref_models, to_models):
-            rmsd = align_points(
-                ref_model.atoms.scene_coords, to_model.atoms.scene_coords
-            )[1]
-    else:
-        rmsd = align_points(ref_model.atoms.scene_coords, to_model.atoms.scene_coords)[
-            1
-        ]
-    return rmsd
+    def rmsd_matrix(self):
+        """
+        Every pairwise RMSD of the solutions as a condensed matrix and the
+        position of each solution in it, or None if cancelled. With
+        ``keep``, the matrix is read from the user cache, and stored there
+        when missing, so clustering the same solutions again with other
+        settings is immediate.
+        """
+        paths = self.paths
+        if self.keep:
+            matrices = cache.matrix_cache(self.settings.rmsd_cache_megabytes * 2 ** 20)
+            key, order = cache.solutions_key(
+                paths, repr(self.selection), self.in_place, self.symmetric
+            )
+            matrix = matrices.get(key)
+            if matrix is not None:
+                return matrix, order
+            unique = [None] * (max(order) + 1 if order else 0)
+            for path, i in zip(paths, order):
+                unique[i] = path
+            paths = unique
+        else:
+            order = list(range(len(paths)))
+        rmsd = self.rmsd_kernel(paths)
+        if rmsd is None:
+            return None
+        # The coordinates were read in matrix order
+        self.positions = order
+        self.phase("Calculating all the RMSDs...", max(len(paths) - 1, 0))
+
+        def fill(matrix):
+            return pairwise_rmsd(rmsd, matrix, progress=self.step)
+
+        if self.keep:
+            if not matrices.fits(len(paths)):
+                self.warned.emit(
+                    "The RMSDs of {} solutions take more than the {} MB of "
+                    "rmsd_cache_megabytes, so they are not kept".format(
+                        len(paths), self.settings.rmsd_cache_megabytes
+                    )
+                )
+            matrix = matrices.store(key, len(paths), fill)
+        else:
+            matrix = np.empty(len(paths) * (len(paths) - 1) // 2)
+            if fill(matrix) is False:
+                matrix = None
+        if matrix is None:
+            return None
+        return matrix, order
+
+
+class AssignmentWorker(ClusteringWorker):
+    """
+    Assigns the solutions in ``paths`` to the LeaderClusters
+    ``clusters``, starting new clusters after theirs when needed.
+    """
+
+    def __init__(self, paths, clusters, settings=None, parent=None):
+        super(AssignmentWorker, self).__init__(
+            paths,
+            clusters.cutoff,
+            clusters.selection,
+            clusters.in_place,
+            clusters.symmetric,
+            settings=settings,
+            parent=parent,
+        )
+        self.clusters = clusters
+        # Extended clusters, read by the assignment that follows this one
+        self.extended = None
+
+    def cluster(self):
+        self.phase("Loading the solutions...", len(self.paths))
+        coordinates = load_coordinates(
+            self.paths,
+            self.settings.coordinate_workers,
+            progress=self.step,
+            reference=self.clusters.reference,
+        )
+        if coordinates is None:
+            return None
+        self.phase("Clustering...", len(self.paths))
+        assigned = self.clusters.assign(coordinates, progress=self.step)
+        if assigned is not None:
+            self.extended = assigned[1]
+        return assigned
 
 
 class ToogleBar(QHBoxLayout):